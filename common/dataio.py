@@ -135,6 +135,324 @@ def read_data(infile):
         return real, imag
 
 
+class DatasetView(object):
+    """Read-only array-like over stored data, decoded one item (along the first axis) at a time.
+    Supports len(), iteration, and indexing with an integer or slice followed by any numpy index.
+    """
+    def __init__(self, shape, dtype='float32'):
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._read(i)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        index, rest = key[0], key[1:]
+        if isinstance(index, slice):
+            idx = range(*index.indices(len(self)))
+            data = np.stack([self._read(i) for i in idx]) if idx else \
+                   np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+            return data[(slice(None),) + rest]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index %s out of range for %s items' % (index, len(self)))
+        return self._read(index)[rest]
+
+    def _read(self, i):
+        raise NotImplementedError
+
+
+class PackedMaskView(DatasetView):
+    def __init__(self, dset):
+        super().__init__(dset.attrs['packed_shape'])
+        self._dset = dset
+        self._size = int(np.prod(self.shape[1:]))
+
+    def _read(self, i):
+        bits = np.unpackbits(self._dset[i])[:self._size]
+        return bits.reshape(self.shape[1:]).astype(self.dtype)
+
+
+class SparseView(DatasetView):
+    def __init__(self, group):
+        super().__init__(group.attrs['sparse_shape'])
+        self._offsets = group['offsets']
+        self._index = group['index']
+        self._values = group['values']
+
+    def _read(self, i):
+        start, stop = self._offsets[i]
+        data = np.zeros((int(np.prod(self.shape[1:-1])), self.shape[-1]), dtype=self.dtype)
+        if stop > start:
+            data[self._index[start:stop]] = self._values[start:stop]
+        return data.reshape(self.shape[1:])
+
+
+class ConcatenatedView(DatasetView):
+    def __init__(self, dsets):
+        super().__init__((sum(len(x) for x in dsets),) + tuple(dsets[0].shape[1:]), dsets[0].dtype)
+        self._dsets = dsets
+        self._offsets = np.cumsum([0] + [len(x) for x in dsets])
+
+    def _read(self, i):
+        j = np.searchsorted(self._offsets, i, side='right') - 1
+        return self._dsets[j][i - self._offsets[j]]
+
+
+class PermutedView(DatasetView):
+    def __init__(self, dset, perm):
+        super().__init__((len(perm),) + tuple(dset.shape[1:]), dset.dtype)
+        self._dset = dset
+        self._perm = perm
+
+    def _read(self, i):
+        return self._dset[self._perm[i]]
+
+
+class ChannelView(DatasetView):
+    """Concatenates datasets along the last axis. Datasets with one dimension fewer than the rest
+    (or all of them, if stack is set) contribute a single channel.
+    """
+    def __init__(self, dsets, stack=False):
+        ndim = max(len(x.shape) for x in dsets) + int(stack)
+        self._expand = [len(x.shape) < ndim for x in dsets]
+        base = [x for x, expand in zip(dsets, self._expand) if not expand]
+        shape = tuple(base[0].shape[:-1]) if base else tuple(dsets[0].shape)
+        channels = sum(1 if expand else x.shape[-1] for x, expand in zip(dsets, self._expand))
+        super().__init__(shape + (channels,), dsets[0].dtype)
+        self._dsets = dsets
+
+    def _read(self, i):
+        return np.concatenate([x[i][..., np.newaxis] if expand else x[i]
+                               for x, expand in zip(self._dsets, self._expand)], axis=-1)
+
+
+# axes that are read or written one index at a time, for each declared access pattern
+ACCESS_PATTERNS = {
+    'scan': (0,),
+    'angle': (0, 1),
+    'channel': (0, -1),
+}
+CHUNK_BYTES = 1 << 22
+# upper bound on the chunk cache of a single dataset, which is sized to hold the chunks touched
+# by indexing one item along its access axes
+CHUNK_CACHE_BYTES = 1 << 28
+CHUNK_CACHE_SLOTS = 10007
+
+
+def _chunk_shape(shape, itemsize, access):
+    axes = {x % len(shape) for x in ACCESS_PATTERNS.get(access, access)}
+    chunk = [1 if i in axes else x for i, x in enumerate(shape)]
+    while np.prod(chunk) * itemsize > CHUNK_BYTES:
+        free = [i for i in range(len(chunk)) if i not in axes and chunk[i] > 1]
+        if not free:
+            break
+        i = max(free, key=lambda i: chunk[i])
+        chunk[i] = (chunk[i] + 1) // 2
+    return tuple(max(x, 1) for x in chunk)
+
+
+def _chunk_cache_bytes(shape, chunks, itemsize, axes):
+    axes = {x % len(shape) for x in axes}
+    size = itemsize
+    for i, (x, c) in enumerate(zip(shape, chunks)):
+        size *= c if i in axes else -(-x // c) * c
+    return int(min(size, CHUNK_CACHE_BYTES))
+
+
+def create_dataset(f, name, shape, dtype='float32', access='scan', compress=False,
+                   precision='float32'):
+    """Create a chunked dataset laid out for the given access pattern, either a name from
+    ACCESS_PATTERNS or a tuple of axes indexed one at a time. Compression (lzf) is only worth it
+    for data that is mostly constant, such as masks, probabilities and depth maps. Float data
+    stored with a precision other than float32 is returned wrapped in an EncodedView.
+    """
+    shape = tuple(int(x) for x in shape)
+    kwargs = {}
+    if compress:
+        kwargs = {'compression': 'lzf', 'shuffle': True}
+    if precision != 'float32':
+        dtype = PRECISIONS[precision][0]
+    axes = ACCESS_PATTERNS.get(access, access)
+    chunks = _chunk_shape(shape, np.dtype(dtype).itemsize, access) if all(shape) else None
+    if chunks is not None:
+        kwargs['rdcc_nbytes'] = _chunk_cache_bytes(shape, chunks, np.dtype(dtype).itemsize, axes)
+        kwargs['rdcc_nslots'] = CHUNK_CACHE_SLOTS
+    dset = f.create_dataset(name, shape, dtype=dtype, chunks=chunks, **kwargs)
+    dset.attrs['access'] = [x % len(shape) for x in axes]
+    if precision != 'float32':
+        dset.attrs['precision'] = precision
+        return EncodedView(dset, precision)
+    return dset
+
+
+class _File(h5py.File):
+    """Opens chunked datasets with a chunk cache sized from their chunks and access pattern,
+    rather than the file-wide default."""
+    def __getitem__(self, name):
+        obj = super().__getitem__(name)
+        if not isinstance(obj, h5py.Dataset) or obj.chunks is None:
+            return obj
+        axes = obj.attrs.get('access', ACCESS_PATTERNS['scan'])
+        nbytes = _chunk_cache_bytes(obj.shape, obj.chunks, obj.dtype.itemsize, axes)
+        path = obj.name.encode('utf-8')
+        # the cache settings of a dataset are fixed by the first open handle, so close it first
+        obj.id.close()
+        dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+        dapl.set_chunk_cache(CHUNK_CACHE_SLOTS, nbytes, 0.75)
+        return h5py.Dataset(h5py.h5d.open(self.id, path, dapl=dapl))
+
+
+def open_hdf5(filename, mode='r'):
+    return _File(filename, mode)
+
+
+# storage type of each precision, and the value range that integer types are scaled over
+PRECISIONS = {
+    'float32': ('float32', None, None),
+    'float16': ('float16', None, None),
+    'prob8': ('uint8', 0, 1),
+    'prob16': ('uint16', 0, 1),
+    'depth16': ('uint16', 0, 2),
+}
+# storage precision of cached intermediates; changing an entry only affects caches built after it,
+# so check the effect on log loss with get_precision_logloss_delta before rebuilding downstream.
+# integer precisions round values near zero to zero, which body zone maps can't tolerate.
+PRECISION_POLICY = {
+    'depth_maps': 'float32',
+    'body_zones': 'float32',
+    'multitask_predictions': 'float32',
+    'hourglass_predictions': 'float32',
+}
+
+
+def encode(data, precision):
+    dtype, low, high = PRECISIONS[precision]
+    if low is None:
+        return np.asarray(data, dtype=dtype)
+    data = np.clip((np.asarray(data) - low) / (high - low), 0, 1)
+    return np.round(data * np.iinfo(dtype).max).astype(dtype)
+
+
+def decode(data, precision):
+    dtype, low, high = PRECISIONS[precision]
+    if low is None:
+        return np.asarray(data, dtype='float32')
+    return np.asarray(data, dtype='float32') * ((high - low) / np.iinfo(dtype).max) + low
+
+
+class EncodedView(DatasetView):
+    def __init__(self, dset, precision):
+        super().__init__(dset.shape)
+        self._dset = dset
+        self._precision = precision
+
+    def _read(self, i):
+        return decode(self._dset[i], self._precision)
+
+    def __setitem__(self, key, value):
+        self._dset[key] = encode(value, self._precision)
+
+
+class RoundTripView(DatasetView):
+    """Float data as it would read back after being stored with the given precision."""
+    def __init__(self, dset, precision):
+        super().__init__(dset.shape)
+        self._dset = dset
+        self._precision = precision
+
+    def _read(self, i):
+        return decode(encode(self._dset[i], self._precision), self._precision)
+
+
+def create_packed_mask_dataset(f, name, shape):
+    dset = create_dataset(f, name, (shape[0], (int(np.prod(shape[1:]))+7)//8), dtype='uint8',
+                          compress=True)
+    dset.attrs['packed_shape'] = shape
+    return dset
+
+
+def pack_mask(mask):
+    return np.packbits(np.asarray(mask, dtype=bool).reshape(-1))
+
+
+def create_sparse_dataset(f, name, shape):
+    group = f.create_group(name)
+    group.attrs['sparse_shape'] = shape
+    group.create_dataset('offsets', (shape[0], 2), dtype='int64')
+    group.create_dataset('index', (0,), maxshape=(None,), chunks=(1<<16,), dtype='uint32',
+                         compression='lzf', shuffle=True)
+    group.create_dataset('values', (0, shape[-1]), maxshape=(None, shape[-1]),
+                         chunks=(1<<14, shape[-1]), dtype='float32')
+    return group
+
+
+def write_sparse(group, i, data):
+    data = np.reshape(data, (-1, data.shape[-1]))
+    index = np.flatnonzero(np.any(data != 0, axis=-1))
+    start = group['index'].shape[0]
+    stop = start + len(index)
+    for name, values in (('index', index), ('values', data[index])):
+        group[name].resize(stop, axis=0)
+        group[name][start:stop] = values
+    group['offsets'][i] = (start, stop)
+
+
+def create_compact_zones_dataset(f, name, shape, n_top=2):
+    """Soft zone maps stored as the n_top most likely zone indices of each pixel with their share
+    of the pixel's total, quantized to uint8."""
+    group = f.create_group(name)
+    group.attrs['compact_shape'] = shape
+    for key in ('index', 'weight'):
+        create_dataset(group, key, tuple(shape[:-1]) + (n_top,), dtype='uint8', compress=True)
+    return group
+
+
+def write_compact_zones(group, i, data):
+    n_top = group['index'].shape[-1]
+    index = np.argpartition(-data, n_top-1, axis=-1)[..., :n_top]
+    total = np.maximum(np.sum(data, axis=-1, keepdims=True), 1e-12)
+    group['index'][i] = index.astype('uint8')
+    group['weight'][i] = encode(np.take_along_axis(data, index, axis=-1) / total, 'prob8')
+
+
+class CompactZonesView(DatasetView):
+    def __init__(self, group):
+        super().__init__(group.attrs['compact_shape'])
+        self._index = group['index']
+        self._weight = group['weight']
+
+    def read_compact(self, i):
+        return self._index[i], decode(self._weight[i], 'prob8')
+
+    def _read(self, i):
+        index, weight = self.read_compact(i)
+        data = np.zeros(self.shape[1:], dtype=self.dtype)
+        np.put_along_axis(data, index.astype('int64'), weight, axis=-1)
+        return data
+
+
+def open_dataset(f, name):
+    dset = f[name]
+    if isinstance(dset, h5py.Group) and 'sparse_shape' in dset.attrs:
+        return SparseView(dset)
+    if isinstance(dset, h5py.Group) and 'compact_shape' in dset.attrs:
+        return CompactZonesView(dset)
+    if 'packed_shape' in dset.attrs:
+        return PackedMaskView(dset)
+    if 'precision' in dset.attrs:
+        return EncodedView(dset, dset.attrs['precision'])
+    return dset
+
+
 @cached(version=0)
 def get_passenger_clusters():
     n_clusters = 24
@@ -297,9 +615,9 @@ def get_aps_data_hdf5(mode):
     if not os.path.exists('done'):
         names = []
         labels = []
-        f = h5py.File('data.hdf5', 'w')
+        f = open_hdf5('data.hdf5', 'w')
         gen = get_data(mode, 'aps')
-        x = f.create_dataset('x', (len(gen), 660, 512, 16))
+        x = create_dataset(f, 'x', (len(gen), 660, 512, 16))
         for i, (name, label, data) in enumerate(tqdm.tqdm(gen)):
             names.append(name)
             labels.append(label)
@@ -311,7 +629,7 @@ def get_aps_data_hdf5(mode):
             f.write('\n'.join(names))
         open('done', 'w').close()
     else:
-        f = h5py.File('data.hdf5', 'r')
+        f = open_hdf5('data.hdf5')
         x = f['x']
         labels = np.load('labels.npy')
         with open('names.txt') as f:
@@ -184,20 +184,16 @@ def _clear_dir(dirName):
         pass
 
 
-def get_tempdir():
-    """ Get the temporary directory where pyelastix stores its temporary
-    files. The directory is specific to the current process and the
-    calling thread. Generally, the user does not need this; directories
-    are automatically cleaned up. Though Elastix log files are also
-    written here.
+# Root of the per-process temp dirs. Point PYELASTIX_TEMPDIR at a RAM-backed
+# filesystem such as /dev/shm to keep the image files off disk.
+TEMPDIR_ROOT = os.environ.get('PYELASTIX_TEMPDIR', tempfile.gettempdir())
+
+_TEMPDIRS = {}
+
+
+def _clear_stale_tempdirs(tempdir):
+    """ Remove the temp dirs of processes that no longer exist.
     """
-    tempdir = os.path.join(tempfile.gettempdir(), 'pyelastix')
-    
-    # Make sure it exists
-    if not os.path.isdir(tempdir):
-        os.makedirs(tempdir)
-    
-    # Clean up all directories for which the process no longer exists
     for fname in os.listdir(tempdir):
         dirName = os.path.join(tempdir, fname)
         # Check if is right kind of dir
@@ -210,13 +206,38 @@ def get_tempdir():
             continue
         if not _is_pid_running(pid):
             _clear_dir(dirName)
-    
-    # Select dir that included process and thread id
+
+
+def get_tempdir():
+    """ Get the temporary directory where pyelastix stores its temporary
+    files. The directory is specific to the current process and the
+    calling thread. Generally, the user does not need this; directories
+    are automatically cleaned up. Though Elastix log files are also
+    written here. The directory is resolved once per process and thread,
+    and stale directories are only cleaned up on the first call.
+    """
+    pid = os.getpid()
     tid = id(threading.current_thread() if hasattr(threading, 'current_thread')
                                         else threading.currentThread())
-    dir = os.path.join(tempdir, 'id_%i_%i' % (os.getpid(), tid))
+    dir = _TEMPDIRS.get((pid, tid))
+    if dir is not None:
+        return dir
+    
+    tempdir = os.path.join(TEMPDIR_ROOT, 'pyelastix')
+    
+    # Make sure it exists
+    if not os.path.isdir(tempdir):
+        os.makedirs(tempdir)
+    
+    # Clean up all directories for which the process no longer exists
+    if not any(key[0] == pid for key in _TEMPDIRS):
+        _clear_stale_tempdirs(tempdir)
+    
+    # Select dir that included process and thread id
+    dir = os.path.join(tempdir, 'id_%i_%i' % (pid, tid))
     if not os.path.isdir(dir):
         os.mkdir(dir)
+    _TEMPDIRS[pid, tid] = dir
     return dir
 
 
@@ -267,13 +288,15 @@ def _get_image_paths(im1, im2):
 
 # %% Some helper stuff
 
-def _system3(cmd, verbose=False):
+def _system3(cmd, verbose=False, timeout=None):
     """ Execute the given command in a subprocess and wait for it to finish.
     A thread is run that prints output of the process if verbose is True.
+    If the process runs longer than timeout seconds, it is killed.
     """
     
-    # Init flag
+    # Init flags
     interrupted = False
+    timed_out = False
     
     # Create progress
     if verbose > 0:
@@ -308,9 +331,14 @@ def _system3(cmd, verbose=False):
     my_thread.start()
     
     # Wait here
+    t0 = time.time()
     try:
         while p.poll() is None:
             time.sleep(0.01)
+            if timeout is not None and time.time() - t0 > timeout:
+                timed_out = True
+                p.kill()
+                p.wait()
     except KeyboardInterrupt:
         # Set flag
         interrupted = True
@@ -328,6 +356,8 @@ def _system3(cmd, verbose=False):
     # All good?
     if interrupted:
         raise RuntimeError('Registration process interrupted by the user.')
+    if timed_out:
+        raise RuntimeError('Registration process timed out after %s seconds.' % timeout)
     if p.returncode:
         stdout.append(p.stdout.read().decode())
         print(''.join(stdout))
@@ -397,8 +427,10 @@ class Progress:
 # %% The Elastix registration class
 
 
-def register(im1, im2, params, exact_params=False, verbose=1):
-    """ register(im1, im2, params, exact_params=False, verbose=1)
+def register(im1, im2, params, exact_params=False, verbose=1, timeout=None,
+             deformation_field=True, stacked=False):
+    """ register(im1, im2, params, exact_params=False, verbose=1, timeout=None,
+                 deformation_field=True, stacked=False)
     
     Perform the registration of `im1` to `im2`, using the given 
     parameters. Returns `(im1_deformed, field)`, where `field` is a
@@ -428,6 +460,17 @@ def register(im1, im2, params, exact_params=False, verbose=1):
         produced by the Elastix executable. Note that error messages
         produced by Elastix will be printed regardless of the verbose
         level.
+    * timeout (float or None):
+        If given, each Elastix process is killed after this many seconds
+        and a RuntimeError is raised.
+    * deformation_field (bool):
+        If False, Transformix is not run and `field` is None. Use this
+        when only the deformed image is needed.
+    * stacked (bool):
+        If True, `im1` and `im2` are stacks of images along their first
+        axis, and each moving slice is registered to the corresponding
+        fixed slice in a single Elastix call using a B-spline stack
+        transform. The deformed stack is returned.
     
     If `im1` is a list of images, performs a groupwise registration.
     In this case the resulting `field` is a list of fields, each
@@ -482,6 +525,24 @@ def register(im1, im2, params, exact_params=False, verbose=1):
         pyramidsamples.reverse()
         params['ImagePyramidSchedule'] = pyramidsamples
     
+    # Stack of pairwise registrations?
+    if stacked:
+        ndim = im1.ndim - 1
+        params['Transform'] = 'BSplineStackTransform'
+        params['Interpolator'] = 'ReducedDimensionBSplineInterpolator'
+        params['ResampleInterpolator'] = 'FinalReducedDimensionBSplineInterpolator'
+        params['FixedImagePyramid'] = 'FixedSmoothingImagePyramid'
+        params['MovingImagePyramid'] = 'MovingSmoothingImagePyramid'
+        # Keep the number of samples per slice
+        if 'NumberOfSpatialSamples' in params:
+            params['NumberOfSpatialSamples'] *= im1.shape[0]
+        # No smoothing along the stack dimension
+        pyramidsamples = []
+        for i in range(params['NumberOfResolutions']):
+            pyramidsamples.extend( [0]+[2**i]*ndim )
+        pyramidsamples.reverse()
+        params['ImagePyramidSchedule'] = pyramidsamples
+    
     # Get paths of input images
     path_im1, path_im2 = _get_image_paths(im1, im2)
     
@@ -500,7 +561,7 @@ def register(im1, im2, params, exact_params=False, verbose=1):
                    '-out', tempdir, '-p', path_params]
         if verbose:
             print("Calling Elastix to register images ...")
-        _system3(command, verbose)
+        _system3(command, verbose, timeout)
         
         # Try and load result
         try:
@@ -509,13 +570,17 @@ def register(im1, im2, params, exact_params=False, verbose=1):
             tmp = "An error occured during registration: " + str(why)
             raise RuntimeError(tmp)
     
+    if not deformation_field:
+        _clear_temp_dir()
+        return a, None
+    
     # Find deformation field
     if True:
         
         # Compile command to execute
         command = [get_elastix_exes()[1],
                    '-def', 'all', '-out', tempdir, '-tp', path_trafo_params]
-        _system3(command, verbose)
+        _system3(command, verbose, timeout)
         
         # Try and load result
         try:
@@ -0,0 +1,134 @@
+import common.pyelastix
+
+import numpy as np
+import scipy.ndimage
+import hashlib
+import os
+
+
+# directory for reusing registrations across runs and stages, or None to disable; a full
+# augmentation run stores a 660x512 float32 image for every slice pair, a few TB in total
+REGISTRATION_STORE_DIR = None
+
+
+class ElastixBackend(object):
+    """Deformable registration with the elastix binary, one call per slice or per stack."""
+
+    def __init__(self, params=None, stacked=False):
+        self.params = params if params is not None else common.pyelastix.get_default_params()
+        self.stacked = stacked
+        self.batched = stacked
+
+    def digest(self):
+        params = self.params
+        if isinstance(params, common.pyelastix.Parameters):
+            params = params.as_dict()
+        text = repr((sorted(params.items()), self.stacked))
+        return hashlib.md5(text.encode('utf-8')).hexdigest()[:16]
+
+    def register(self, im1, im2, timeout=None):
+        if self.stacked:
+            reg, _ = common.pyelastix.register(np.stack(im1), np.stack(im2), self.params,
+                                               verbose=0, timeout=timeout,
+                                               deformation_field=False, stacked=True)
+            return list(reg)
+        return [common.pyelastix.register(x, y, self.params, verbose=0, timeout=timeout,
+                                          deformation_field=False)[0]
+                for x, y in zip(im1, im2)]
+
+
+class DemonsBackend(object):
+    """In-process multi-resolution demons registration of a batch of 2D slices."""
+
+    batched = True
+
+    def __init__(self, levels=4, iterations=64, sigma=2.0, alpha=1.0):
+        self.levels, self.iterations, self.sigma, self.alpha = levels, iterations, sigma, alpha
+
+    def digest(self):
+        text = repr(('demons', self.levels, self.iterations, self.sigma, self.alpha))
+        return hashlib.md5(text.encode('utf-8')).hexdigest()[:16]
+
+    def register(self, im1, im2, timeout=None):
+        return list(register_demons(np.stack(im1), np.stack(im2), self.levels, self.iterations,
+                                    self.sigma, self.alpha))
+
+
+REGISTRATION_BACKENDS = {
+    'elastix': ElastixBackend,
+    'demons': DemonsBackend,
+}
+
+
+class RegistrationStore(object):
+    """Warped images and residuals keyed by (moving, fixed, angle, modality) and backend digest."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key, digest):
+        moving, fixed, angle, modality = key
+        return '%s/%s/%s/%s_%s_%s.npz' % (self.root, modality, fixed, moving, angle, digest)
+
+    def get(self, key, digest):
+        path = self._path(key, digest)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return data['warped'], data['residual']
+
+    def put(self, key, digest, warped, residual):
+        path = self._path(key, digest)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, warped=np.asarray(warped, dtype='float32'), residual=residual)
+        os.rename(tmp, path)
+
+
+def get_registration_store():
+    return RegistrationStore(REGISTRATION_STORE_DIR) if REGISTRATION_STORE_DIR else None
+
+
+def _identity_grid(shape):
+    return np.mgrid[:shape[0], :shape[1], :shape[2]].astype('float32')
+
+
+def _warp(im, field, grid):
+    coords = [grid[0], grid[1] + field[:, 0], grid[2] + field[:, 1]]
+    return scipy.ndimage.map_coordinates(im, coords, order=1, mode='constant', cval=0)
+
+
+def _downsample(im, factor):
+    if factor == 1:
+        return im
+    im = scipy.ndimage.gaussian_filter(im, (0, factor/2, factor/2))
+    return scipy.ndimage.zoom(im, (1, 1/factor, 1/factor), order=1)
+
+
+def register_demons(moving, fixed, levels=4, iterations=64, sigma=2.0, alpha=1.0):
+    """Warp each moving slice (axis 0) onto the matching fixed slice with Thirion's demons."""
+    moving, fixed = np.asarray(moving, dtype='float32'), np.asarray(fixed, dtype='float32')
+
+    field = None
+    for level in reversed(range(levels)):
+        factor = 2**level
+        m, f = _downsample(moving, factor), _downsample(fixed, factor)
+        if field is None:
+            field = np.zeros((f.shape[0], 2) + f.shape[1:], dtype='float32')
+        else:
+            zoom = (1, 1, f.shape[1]/field.shape[2], f.shape[2]/field.shape[3])
+            field = 2 * scipy.ndimage.zoom(field, zoom, order=1)
+
+        grid = _identity_grid(f.shape)
+        grad = np.stack(np.gradient(f, axis=(1, 2)), axis=1)
+        grad_sq = np.sum(np.square(grad), axis=1)
+        for _ in range(iterations):
+            diff = _warp(m, field, grid) - f
+            denom = grad_sq + alpha**2 * np.square(diff)
+            scale = np.where(denom > 1e-9, -diff / np.maximum(denom, 1e-9), 0)
+            field += scale[:, np.newaxis] * grad
+            field = scipy.ndimage.gaussian_filter(field, (0, 0, sigma, sigma))
+
+    return _warp(moving, field, _identity_grid(moving.shape))
@@ -0,0 +1,130 @@
+import os
+import random
+import socket
+import threading
+import time
+
+
+class WorkQueue(object):
+    """Items leased by workers through lock files in a directory shared between machines.
+
+    A lease is created with O_EXCL and kept alive by touching it from a heartbeat thread. Leases
+    that have not been touched for lease_timeout seconds are reclaimed by other workers, and an
+    item is finished once its done marker exists. An item can rarely be processed twice when a
+    lease is reclaimed concurrently, so work per item must be idempotent.
+    """
+
+    def __init__(self, path, items, lease_timeout=1800, poll_interval=60):
+        self.path = path
+        self.items = list(items)
+        self.lease_timeout, self.poll_interval = lease_timeout, poll_interval
+        for subdir in ('leases', 'done'):
+            if not os.path.exists('%s/%s' % (path, subdir)):
+                os.makedirs('%s/%s' % (path, subdir), exist_ok=True)
+
+    @staticmethod
+    def _owner():
+        return '%s %s\n' % (socket.gethostname(), os.getpid())
+
+    def _owns(self, item):
+        try:
+            with open(self._lease_path(item)) as f:
+                return f.read() == self._owner()
+        except OSError:
+            return False
+
+    def _lease_path(self, item):
+        return '%s/leases/%s' % (self.path, item)
+
+    def _done_path(self, item):
+        return '%s/done/%s' % (self.path, item)
+
+    def is_done(self, item):
+        return os.path.exists(self._done_path(item))
+
+    def remaining(self):
+        return [item for item in self.items if not self.is_done(item)]
+
+    def _try_lease(self, item):
+        path = self._lease_path(item)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            age = None
+        if age is not None:
+            if age < self.lease_timeout:
+                return False
+            # expired lease: only the worker whose rename succeeds may reclaim it
+            expired = '%s.expired.%s.%s' % (path, socket.gethostname(), os.getpid())
+            try:
+                os.rename(path, expired)
+            except OSError:
+                return False
+            os.remove(expired)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+        os.write(fd, self._owner().encode('utf-8'))
+        os.close(fd)
+        if self.is_done(item):
+            os.remove(path)
+            return False
+        return True
+
+    def lease(self):
+        """Lease an unfinished item, or return None if all items are finished or leased."""
+        items = self.remaining()
+        random.shuffle(items)
+        for item in items:
+            if self._try_lease(item):
+                return item
+        return None
+
+    def heartbeat(self, item):
+        if self._owns(item):
+            os.utime(self._lease_path(item), None)
+
+    def release(self, item):
+        """Remove the lease on item, unless it has been reclaimed by another worker."""
+        if not self._owns(item):
+            return
+        try:
+            os.remove(self._lease_path(item))
+        except OSError:
+            pass
+
+    def complete(self, item):
+        open(self._done_path(item), 'w').close()
+        self.release(item)
+
+    def __iter__(self):
+        """Yield leased items until every item is finished, heartbeating each while it is held.
+
+        An item is marked done when the consumer asks for the next one, and released if the
+        consumer raises.
+        """
+        while self.remaining():
+            item = self.lease()
+            if item is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            stop = threading.Event()
+
+            def beat():
+                while not stop.wait(self.lease_timeout / 4):
+                    self.heartbeat(item)
+
+            thread = threading.Thread(target=beat)
+            thread.daemon = True
+            thread.start()
+            try:
+                yield item
+            except BaseException:
+                self.release(item)
+                raise
+            finally:
+                stop.set()
+                thread.join()
+            self.complete(item)
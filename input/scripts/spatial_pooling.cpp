@@ -1,13 +1,16 @@
-#include <string>
-#include <fstream>
-#include <cstring>
+#include <cstdio>
 #include <cmath>
-#include <cassert>
+#include <vector>
 #include <algorithm>
 #define rep(i, N) for(int i = 0; i < N; i++)
 using namespace std;
 
 
+// same pooling as spatial_pooling_v0.cpp, except that rasterization only tracks depth and the
+// source column instead of copying every channel; by default the median is taken over depth and
+// all channels are gathered from the hull at the median depth, while per_channel takes the median
+// of every channel separately as v0 does. Built as a shared library, spatial_pool runs in-process
+// on a batch of scans.
 const int A = 16,
 		  N = 330,
 		  M = 256,
@@ -16,11 +19,11 @@ const int A = 16,
 const double PI = 4*atan(1);
 
 
-pair<double, double> rotate_point(double x, double y, double angle) {
+pair<double, double> rotate_point(double x, double y, double c, double s) {
 	y *= M;
 	x -= M/2;
 	y -= M/2;
-	double rx = cos(angle)*x - sin(angle)*y, ry = sin(angle)*x + cos(angle)*y;
+	double rx = c*x - s*y, ry = s*x + c*y;
 	x = rx + M/2;
 	y = ry + M/2;
 	y /= M;
@@ -29,104 +32,124 @@ pair<double, double> rotate_point(double x, double y, double angle) {
 }
 
 
-void rotate_hulls(float hulls[A][N][M][K], float out[A][N][M][K], int base) {
-	rep(a, A) rep(i, N) rep(j, M) {
-		out[a][i][j][0] = 1.0;
-		for(int k = 1; k < K; k++) {
-			out[a][i][j][k] = 0.0;
-		}
+// depth and source column of hull a rotated by angle (a-base), -1 where nothing is visible
+void rotate_hull(float hulls[A][N][M][K], float depth[N][M], short src[N][M], int a, int base) {
+	double angle = 2*PI/A*(a-base), c = cos(angle), s = sin(angle);
+	rep(i, N) rep(j, M) {
+		depth[i][j] = 1.0;
+		src[i][j] = -1;
 	}
-	rep(a, A) rep(i, N) rep(j, M-1) {
-		if(hulls[a][i][j][0] == 1 || hulls[a][i][j+1][0] == 1) {
-			continue;
-		}
-		if(abs(hulls[a][i][j][0] - hulls[a][i][j+1][0]) > 0.1) {
+	rep(i, N) rep(j, M-1) {
+		float d1 = hulls[a][i][j][0], d2 = hulls[a][i][j+1][0];
+		if(d1 == 1 || d2 == 1 || abs(d1 - d2) > 0.1) {
 			continue;
 		}
-		double angle = 2*PI/A*(a-base);
-		auto p1 = rotate_point(j, hulls[a][i][j][0], angle),
-			 p2 = rotate_point(j+1, hulls[a][i][j+1][0], angle);
+		auto p1 = rotate_point(j, d1, c, s),
+			 p2 = rotate_point(j+1, d2, c, s);
 		for(int jj = p1.first; jj <= p2.first; jj++) {
 			double d = p1.second + (p2.second-p1.second)*(jj-p1.first)/(p2.first-p1.first);
-			if(d < out[a][i][jj][0]) {
-				out[a][i][jj][0] = d;
-				for(int k = 1; k < K; k++) {
-					out[a][i][jj][k] = hulls[a][i][j][k];
-				}
+			if(d < depth[i][jj]) {
+				depth[i][jj] = d;
+				src[i][jj] = j;
 			}
 		}
 	}
 }
 
 
-float rotbuf[A][N][M][K];
-float pools[N][M][K][L];
-void spatial_pool_hulls(float hulls[A][N][M][K], float out[A][N][M][K]) {
-	rep(a, A) rep(i, N) rep(j, M) rep(k, K) {
-		out[a][i][j][k] = 0;
+void spatial_pool_base(float hulls[A][N][M][K], float out[A][N][M][K], int base,
+					   bool per_channel) {
+	vector<float> depth_buf(A*N*M);
+	vector<short> src_buf(A*N*M);
+	auto depth = reinterpret_cast<float (*)[N][M]>(depth_buf.data());
+	auto src = reinterpret_cast<short (*)[N][M]>(src_buf.data());
+	rep(a, A) {
+		rotate_hull(hulls, depth[a], src[a], a, base);
 	}
 
-	rep(a, A) {
-		rotate_hulls(hulls, rotbuf, a);
-		rep(i, N) rep(j, M) {
-			if(hulls[a][i][j][0] == 1) {
-				continue;
-			}
-			rep(l, L) rep(k, K) {
-				pools[i][j][k][l] = 1;
-			}
-			rep(aa, A) {
-				int maxd = 0;
-				rep(l, L) {
-					if(pools[i][j][0][maxd] < pools[i][j][0][l]) {
-						maxd = l;
-					}
-				}
-				if(rotbuf[aa][i][j][0] < pools[i][j][0][maxd]) {
-					rep(k, K) {
-						pools[i][j][k][maxd] = rotbuf[aa][i][j][k];
-					}
-				}
-			}
-			int num = 0;
+	rep(i, N) rep(j, M) {
+		rep(k, K) {
+			out[base][i][j][k] = 0;
+		}
+		if(hulls[base][i][j][0] == 1) {
+			continue;
+		}
+		float pool_depth[L];
+		int pool_angle[L];
+		rep(l, L) {
+			pool_depth[l] = 1;
+			pool_angle[l] = -1;
+		}
+		rep(aa, A) {
+			int maxd = 0;
 			rep(l, L) {
-				num += pools[i][j][0][l] != 1.0;
+				if(pool_depth[maxd] < pool_depth[l]) {
+					maxd = l;
+				}
 			}
-			if(num == 0) {
-				continue;
+			if(depth[aa][i][j] < pool_depth[maxd]) {
+				pool_depth[maxd] = depth[aa][i][j];
+				pool_angle[maxd] = aa;
 			}
+		}
+		int num = 0, order[L];
+		rep(l, L) {
+			num += pool_depth[l] != 1.0;
+			order[l] = l;
+		}
+		if(num == 0) {
+			continue;
+		}
+		if(per_channel) {
+			float vals[L];
 			rep(k, K) {
-				sort(pools[i][j][k], pools[i][j][k]+L);
-				out[a][i][j][k] = pools[i][j][k][num/2];
+				rep(l, L) {
+					int aa = pool_angle[l];
+					vals[l] = aa < 0 ? 1 : k == 0 ? pool_depth[l] : hulls[aa][i][src[aa][i][j]][k];
+				}
+				sort(vals, vals+L);
+				out[base][i][j][k] = vals[num/2];
 			}
+			continue;
+		}
+		stable_sort(order, order+L, [&](int l1, int l2) {
+			return pool_depth[l1] < pool_depth[l2];
+		});
+		int aa = pool_angle[order[num/2]];
+		out[base][i][j][0] = pool_depth[order[num/2]];
+		for(int k = 1; k < K; k++) {
+			out[base][i][j][k] = hulls[aa][i][src[aa][i][j]][k];
 		}
 	}
 }
 
 
-void read_hulls(string filename, float hulls[A][N][M][K]) {
-	ifstream fin(filename, ios::binary);
-	rep(a, A) rep(i, N) rep(j, M) rep(k, K) {
-		fin.read(reinterpret_cast<char*>(&hulls[a][i][j][k]), sizeof(float));
+// pools n scans of (A, N, M, K) hulls stored contiguously, in parallel over scans and base angles
+extern "C" void spatial_pool(float *hulls, float *out, int n, int per_channel) {
+	typedef float scan[A][N][M][K];
+	auto hulls_scans = reinterpret_cast<scan*>(hulls);
+	auto out_scans = reinterpret_cast<scan*>(out);
+	#pragma omp parallel for schedule(dynamic) collapse(2)
+	rep(s, n) rep(base, A) {
+		spatial_pool_base(hulls_scans[s], out_scans[s], base, per_channel);
 	}
-	fin.close();
 }
 
 
-void write_hulls(string filename, float hulls[A][N][M][K]) {
-	ofstream fout(filename, ios::binary);
-	rep(a, A) rep(i, N) rep(j, M) rep(k, K) {
-		fout.write(reinterpret_cast<char*>(&hulls[a][i][j][k]), sizeof(float));
+int main(int argc, char **argv) {
+	const size_t size = A*N*M*K;
+	vector<float> hulls(size), out(size);
+	FILE *fin = fopen(argv[1], "rb");
+	if(!fin || fread(hulls.data(), sizeof(float), size, fin) != size) {
+		return 1;
 	}
-	fout.close();
-}
+	fclose(fin);
 
+	spatial_pool(hulls.data(), out.data(), 1, argc > 3);
 
-float hulls[A][N][M][K];
-float out[A][N][M][K];
-int main(int argc, char **argv) {
-	read_hulls(argv[1], hulls);
-	//rotate_hulls(hulls, out, 1);
-	spatial_pool_hulls(hulls, out);
-	write_hulls(argv[2], out);
-}
\ No newline at end of file
+	FILE *fout = fopen(argv[2], "wb");
+	if(!fout || fwrite(out.data(), sizeof(float), size, fout) != size) {
+		return 1;
+	}
+	fclose(fout);
+}
@@ -1,6 +1,6 @@
 from common.caching import cached, read_log_dir
 from common.math import sigmoid, log_loss
-from common.dataio import get_train_idx, get_valid_idx, get_data
+from common.dataio import get_train_idx, get_valid_idx, get_data, create_dataset, open_hdf5
 
 from . import tf_models
 from . import dataio
@@ -14,16 +14,14 @@ import time
 import tqdm
 import math
 import random
-import h5py
-import skimage.transform
 
 
 @cached(get_data, subdir='ssd', version=0)
 def get_downsized_a3d_data(mode, downsize=4):
     if not os.path.exists('done'):
         gen = get_data(mode, 'a3d')
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(gen), 512//downsize, 512//downsize, 660//downsize))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(gen), 512//downsize, 512//downsize, 660//downsize))
 
         for i, (_, _, data) in enumerate(tqdm.tqdm(gen)):
             dset[i] = data[::downsize, ::downsize, ::downsize]
@@ -31,7 +29,7 @@ def get_downsized_a3d_data(mode, downsize=4):
         f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
+    f = open_hdf5('data.hdf5')
     dset = f['dset']
     return dset
 
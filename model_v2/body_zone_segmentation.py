@@ -1,64 +1,110 @@
 from common.caching import read_input_dir, cached, read_log_dir
-from common.dataio import get_aps_data_hdf5, get_passenger_clusters, get_data
+from common.dataio import get_aps_data_hdf5, get_passenger_clusters, get_data, create_dataset, \
+                          open_hdf5, open_dataset, read_data, create_compact_zones_dataset, \
+                          write_compact_zones, PRECISION_POLICY
 
 from . import dataio
 from . import tf_models
 from . import synthetic_data
+from . import spatial_pooling
 
 import tensorflow as tf
 import numpy as np
-import skimage.transform
 import glob
 import os
 import tqdm
-import h5py
 import pickle
 import imageio
 import math
 import time
 import multiprocessing
-import subprocess
-import string
-import random
-
-
-@cached(get_data, get_aps_data_hdf5, subdir='ssd', version=4)
+import collections
+
+
+# memory held by each worker of the a3d projection and zone stats pools, a full a3d volume plus
+# rotation tables in the worst case
+WORKER_MEMORY = 2 << 30
+
+
+def _get_pool_processes(worker_memory=WORKER_MEMORY):
+    """One process per core, but no more than fit in half of the physical memory."""
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return max(1, min(multiprocessing.cpu_count(), memory // 2 // worker_memory))
+
+
+def _get_rotation_tables(size, angles):
+    """Source voxel of every output pixel for each of the angles, or -1 outside the volume.
+
+    Matches the nearest neighbor sampling of tf.contrib.image.rotate by -2*pi*angle/angles.
+    """
+    y, x = np.mgrid[:size, :size].astype('float32')
+    tables = []
+    for angle in range(angles):
+        theta = np.float32(-2*math.pi*angle/angles)
+        cos, sin = np.cos(theta), np.sin(theta)
+        x_offset = ((size-1) - (cos*(size-1) - sin*(size-1))) / np.float32(2)
+        y_offset = ((size-1) - (sin*(size-1) + cos*(size-1))) / np.float32(2)
+        x_in = cos*x - sin*y + x_offset
+        y_in = sin*x + cos*y + y_offset
+        # std::round rounds halfway cases away from zero
+        x_in = (np.sign(x_in) * np.floor(np.abs(x_in) + 0.5)).astype('int64')
+        y_in = (np.sign(y_in) * np.floor(np.abs(y_in) + 0.5)).astype('int64')
+        valid = (x_in >= 0) & (x_in < size) & (y_in >= 0) & (y_in < size)
+        tables.append(np.where(valid, y_in*size + x_in, -1).ravel())
+    return np.stack(tables)
+
+
+_rotation_tables = None
+
+
+def _get_a3d_projections(args):
+    """Depth, max, mean and std projections of an a3d file for all angles, halved in size."""
+    global _rotation_tables
+    file, percentile, angles, width = args
+    data = read_data(file)
+    data = (data[::2,::2,::2]+data[::2,::2,1::2]+data[::2,1::2,::2]+
+            data[::2,1::2,1::2]+data[1::2,::2,::2]+data[1::2,::2,1::2]+
+            data[1::2,1::2,::2]+data[1::2,1::2,1::2])/8
+    size, depth = data.shape[0], data.shape[1]
+    if _rotation_tables is None:
+        _rotation_tables = _get_rotation_tables(size, angles)
+
+    # a trailing zero voxel column stands in for samples outside the volume
+    flat = np.concatenate([data.reshape(size*size, -1), np.zeros((1, data.shape[2]), data.dtype)])
+    # percentile with nearest interpolation, as an index into the ascending order
+    k = depth - 1 - int(np.round((depth-1) * (1 - percentile/100)))
+
+    ret = np.zeros((angles, data.shape[2], size, 4), dtype='float32')
+    for angle in range(angles):
+        image = flat[_rotation_tables[angle]].reshape(size, depth, -1)
+        threshold = np.partition(image, k, axis=1)[:, k:k+1]
+        dmap = np.argmax(image > threshold, axis=1) / width
+        proj = np.stack([dmap, np.max(image, axis=1), np.mean(image, axis=1),
+                         np.std(image, axis=1)], axis=-1)
+        ret[angle] = np.rot90(proj)
+    return ret
+
+
+@cached(get_data, get_aps_data_hdf5, subdir='ssd', version=5)
 def get_a3d_projection_data(mode, percentile):
     if not os.path.exists('done'):
         angles, width, height = 16, 512, 660
-        tf.reset_default_graph()
-
-        data_in = tf.placeholder(tf.float32, [width//2, width//2, height//2])
-        angle = tf.placeholder(tf.float32, [])
-
-        with tf.device('/cpu:0'):
-            image = tf.contrib.image.rotate(data_in, -2*math.pi*angle/angles)
-        max_proj = tf.reduce_max(image, axis=1)
-        mean_proj, var_proj = tf.nn.moments(image, axes=[1])
-        std_proj = tf.sqrt(var_proj)
-
-        surf = image > tf.contrib.distributions.percentile(image, percentile, axis=1,
-                                                           keep_dims=True)
-        dmap = tf.cast(tf.argmax(tf.cast(surf, tf.int32), axis=1) / width, tf.float32)
-        proj = tf.image.rot90(tf.stack([dmap, max_proj, mean_proj, std_proj], axis=-1))
 
         gen = get_data(mode, 'a3d')
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(gen), angles, height//2, width//2, 5))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(gen), angles, height//2, width//2, 5), access='angle',
+                              compress=True)
         names, labels, dset_in = get_aps_data_hdf5(mode)
 
-        with tf.Session() as sess:
-            sess.run(tf.global_variables_initializer())
-            for i, (_, _, data) in enumerate(tqdm.tqdm(get_data(mode, 'a3d'))):
-                data = (data[::2,::2,::2]+data[::2,::2,1::2]+data[::2,1::2,::2]+
-                        data[::2,1::2,1::2]+data[1::2,::2,::2]+data[1::2,::2,1::2]+
-                        data[1::2,1::2,::2]+data[1::2,1::2,1::2])/8
-                for j in tqdm.trange(angles):
-                    dset[i, j, ..., :-1] = sess.run(proj, feed_dict={data_in: data, angle: j})
+        args = [(file, percentile, angles, width) for file in gen.files]
+        with multiprocessing.Pool(_get_pool_processes()) as p:
+            projs = p.imap(_get_a3d_projections, args)
+            for i, proj in enumerate(tqdm.tqdm(projs, total=len(args))):
+                dset[i, ..., :-1] = proj
+                for j in range(angles):
                     dset[i, j, ..., -1] = (dset_in[i, ::2, ::2, j]+dset_in[i, ::2, 1::2, j]+
                                            dset_in[i, 1::2, ::2, j]+dset_in[i, 1::2, 1::2, j])
 
-
         f.close()
         with open('pkl', 'wb') as f:
             pickle.dump((names, labels), f)
@@ -66,7 +112,7 @@ def get_a3d_projection_data(mode, percentile):
 
     with open('pkl', 'rb') as f:
         names, labels = pickle.load(f)
-    f = h5py.File('data.hdf5', 'r')
+    f = open_hdf5('data.hdf5')
     dset = f['dset']
     return names, labels, dset
 
@@ -75,8 +121,8 @@ def get_a3d_projection_data(mode, percentile):
 def get_mask_training_data():
     if not os.path.exists('done'):
         names, labels, dset_in = get_a3d_projection_data('sample_large', 97)
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(dset_in), 330, 256, 6))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(dset_in), 330, 256, 6), compress=True)
         name_idx = {x: i for i, x in enumerate(names)}
 
         with read_input_dir('hand_labeling/a3d_projections'):
@@ -98,16 +144,63 @@ def get_mask_training_data():
 
     with open('pkl', 'rb') as f:
         names, labels = pickle.load(f)
-    f = h5py.File('data.hdf5', 'r')
+    f = open_hdf5('data.hdf5')
     dset = f['dset']
     return names, labels, dset
 
 
+def _predict_angle_batches(gen, predict_batch, batch_size):
+    """Run predict_batch(images, angles) on batches of batch_size angles pooled across scans,
+    and yield the stacked predictions of each scan in order.
+
+    The models draw one test-time augmentation per run for the whole batch, so draws are shared
+    by images of different scans. Each image still averages independent draws from the same
+    distribution as before, so only the correlation between images changes, not the expected
+    prediction of any image or its variance.
+    """
+    pending = collections.deque()
+    images, targets = [], []
+
+    def flush():
+        preds = predict_batch(np.stack(images), np.array([j for _, j in targets]))
+        for (ret, j), pred in zip(targets, preds):
+            ret[j] = pred
+        images.clear()
+        targets.clear()
+
+    for data in gen:
+        ret = [None] * len(data)
+        pending.append(ret)
+        for j in range(len(data)):
+            images.append(data[j])
+            targets.append((ret, j))
+            if len(images) == batch_size:
+                flush()
+        while pending and all(x is not None for x in pending[0]):
+            yield np.stack(pending.popleft())
+    if images:
+        flush()
+    while pending:
+        yield np.stack(pending.popleft())
+
+
+def _write_chunks(dset, gen, chunk_size):
+    """Write consecutive scans from gen into dset, chunk_size scans at a time."""
+    buf, i = [], 0
+    for data in gen:
+        buf.append(data)
+        if len(buf) == chunk_size:
+            dset[i:i+len(buf)] = np.stack(buf)
+            i, buf = i + len(buf), []
+    if buf:
+        dset[i:i+len(buf)] = np.stack(buf)
+
+
 @cached(get_mask_training_data, version=6)
 def train_mask_segmentation_cnn(duration, learning_rate=1e-3, model='logistic', min_res=4,
                                 num_filters=16):
     assert model in ('logistic', 'hourglass')
-    angles, height, width, res, filters = 16, 330, 256, 256, 6
+    height, width, res, filters = 330, 256, 256, 6
 
     tf.reset_default_graph()
 
@@ -151,15 +244,19 @@ def train_mask_segmentation_cnn(duration, learning_rate=1e-3, model='logistic',
     saver = tf.train.Saver()
     model_path = os.getcwd() + '/model.ckpt'
 
-    def predict(dset, num_sample=16):
+    def predict(dset, num_sample=16, batch_size=64):
         with tf.Session() as sess:
             saver.restore(sess, model_path)
-            for cur_data in tqdm.tqdm(dset):
-                cur_data = np.concatenate([cur_data, np.zeros(cur_data.shape[:-1] + (1,))], axis=-1)
-                pred = np.zeros((angles, height, width))
+
+            def predict_batch(images, _):
+                shape = images.shape[:-1]
+                images = np.concatenate([images, np.zeros(shape + (1,), dtype='float32')], axis=-1)
+                pred = np.zeros(shape, dtype='float32')
                 for _ in range(num_sample):
-                    pred += sess.run(preds, feed_dict={data_in: cur_data})
-                yield pred / num_sample
+                    pred += np.reshape(sess.run(preds, feed_dict={data_in: images}), shape)
+                return pred / num_sample
+
+            yield from _predict_angle_batches(tqdm.tqdm(dset), predict_batch, batch_size)
 
     if os.path.exists('done'):
         return predict
@@ -219,11 +316,13 @@ def get_depth_maps(mode):
         names, labels, dset_in = get_a3d_projection_data(mode, 97)
         predict = train_mask_segmentation_cnn(0.1, model='hourglass', num_filters=64)
 
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', dset_in.shape[:-1])
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', dset_in.shape[:-1], compress=True,
+                              precision=PRECISION_POLICY['depth_maps'])
 
-        for i, (data, mask) in enumerate(zip(dset_in, predict(dset_in))):
-            dset[i] = data[..., 0] * (mask > 0.5) * 2 + (mask <= 0.5)
+        depth_maps = (data[..., 0] * (mask > 0.5) * 2 + (mask <= 0.5)
+                      for data, mask in zip(dset_in, predict(dset_in)))
+        _write_chunks(dset, depth_maps, 4)
 
         f.close()
         with open('pkl', 'wb') as f:
@@ -232,83 +331,93 @@ def get_depth_maps(mode):
 
     with open('pkl', 'rb') as f:
         names, labels = pickle.load(f)
-    f = h5py.File('data.hdf5', 'r')
-    dset = f['dset']
+    f = open_hdf5('data.hdf5')
+    dset = open_dataset(f, 'dset')
     return names, labels, dset
 
 
+def _get_zone_stats(images):
+    """Corners, mean and std of the body in each image, as rows of x0, y0, x1, y1, mean, std."""
+    stats = np.zeros((len(images), 6))
+    for i, image in enumerate(images):
+        coords = np.argwhere(image < 1)
+        valid = image[image < 1]
+        stats[i] = np.concatenate([np.min(coords, axis=0), np.max(coords, axis=0),
+                                   [np.mean(valid), np.std(valid)]])
+    return stats
+
+
+def _get_zone_distributions(stats):
+    """Mean and std of body height, width and depth per angle, from per image zone stats."""
+    h, w = stats[..., 2] - stats[..., 0], stats[..., 3] - stats[..., 1]
+    return np.stack([
+        np.stack([np.mean(h, axis=0), np.std(h, axis=0)], axis=-1),
+        np.stack([np.mean(w, axis=0), np.std(w, axis=0)], axis=-1),
+        np.stack([np.mean(stats[..., 4], axis=0),
+                  np.sqrt(np.sum(stats[..., 5]**2, axis=0))], axis=-1)
+    ], axis=1)
+
+
+def _resize_nearest(image, shape):
+    """Nearest neighbor resize sampling pixel centers, as skimage.transform.resize with order=0
+    but with ties at pixel edges rounded up exactly."""
+    rows = (2*np.arange(shape[0]) + 1) * image.shape[0] // (2*shape[0])
+    cols = (2*np.arange(shape[1]) + 1) * image.shape[1] // (2*shape[1])
+    return image[rows[:, np.newaxis], cols]
+
+
+def _normalize_synthetic_zone_images(args):
+    """Match the body size and depth of synthetic images at each angle to the real data."""
+    images, stats, distr, distr_in = args
+    ret = np.zeros(images.shape, dtype='float32')
+    for angle, image in enumerate(images):
+        x0, y0, x1, y1 = stats[angle, :4].astype('int64')
+        crop = image[x0:x1, y0:y1]
+        h, w = crop.shape[:2]
+
+        d, d_in = distr[angle], distr_in[angle]
+        hz, wz = (h-d[0, 0])/d[0, 1], (w-d[1, 0])/d[1, 1]
+        hp, wp = hz*d_in[0, 1]+d_in[0, 0], wz*d_in[1, 1]+d_in[1, 0]
+        resized = _resize_nearest(crop, (min(330, int(hp)), min(256, int(wp))))
+        resized = resized[1:-1, 1:-1]
+        h_pad, w_pad = 330-resized.shape[0], (256-resized.shape[1])//2
+        normal = np.stack([
+            np.pad(x, ((h_pad, 0), (w_pad, 256-resized.shape[1]-w_pad)), 'constant',
+                   constant_values=y)
+            for x, y in [(resized[..., 0], 1), (resized[..., 1], 0)]
+        ], axis=-1)
+
+        depth = normal[..., 0]
+        valid = depth < 1
+        depth[valid] = (depth[valid]-d[2, 0])/d[2, 1]*d_in[2, 1]+d_in[2, 0]
+        ret[angle] = normal
+    return ret
+
+
 @cached(synthetic_data.render_synthetic_zone_data, get_depth_maps, cloud_cache=True, subdir='ssd',
-        version=4)
+        version=5)
 def get_normalized_synthetic_zone_data(mode):
     if not os.path.exists('done'):
         _, _, dset_in = get_depth_maps(mode)
         dset = synthetic_data.render_synthetic_zone_data(mode)
-        f = h5py.File('data.hdf5', 'w')
-        dset_out = f.create_dataset('dset', dset.shape)
-
-        def corners(image):
-            coords = np.argwhere(image < 1)
-            return np.min(coords, axis=0), np.max(coords, axis=0)
-
-        def stats(image):
-            (x0, y0), (x1, y1) = corners(image)
-            valid = image[image < 1]
-            mean, std = np.mean(valid), np.std(valid)
-            return x1-x0, y1-y0, mean, std
-
-        def distributions(gen):
-            all_stats = [stats(data) for data in gen]
-            h, w = [x[0] for x in all_stats], [x[1] for x in all_stats]
-            mean_h, std_h = np.mean(h), np.std(h)
-            mean_w, std_w = np.mean(w), np.std(w)
-            mean_v = np.mean([x[2] for x in all_stats])
-            std_v = np.sqrt(np.sum([x[3]**2 for x in all_stats]))
-            return np.array([
-                [mean_h, std_h],
-                [mean_w, std_w],
-                [mean_v, std_v]
-            ])
-
-        def dset_in_gen(angle):
-            for data in tqdm.tqdm(dset_in):
-                yield data[angle]
-
-        def dset_gen(angle):
-            for data in tqdm.tqdm(dset):
-                yield data[angle, ..., 0]
-
-        for angle in tqdm.trange(16):
-            distr_in = distributions(dset_in_gen(angle))
-            distr = distributions(dset_gen(angle))
-
-            for i in tqdm.trange(len(dset)):
-                (x0, y0), (x1, y1) = corners(dset[i, angle, ..., 0])
-                crop = dset[i, angle, x0:x1, y0:y1]
-                h, w = crop.shape[:2]
-
-                hz, wz = (h-distr[0, 0])/distr[0, 1], (w-distr[1, 0])/distr[1, 1]
-                hp, wp = hz*distr_in[0, 1]+distr_in[0, 0], wz*distr_in[1, 1]+distr_in[1, 0]
-                resized = skimage.transform.resize(crop, (min(330, int(hp)), min(256, int(wp))),
-                                                   preserve_range=True, order=0)
-                resized = resized[1:-1, 1:-1]
-                h_pad, w_pad = 330-resized.shape[0], (256-resized.shape[1])//2
-                normal = np.stack([
-                    np.pad(x, ((h_pad, 0), (w_pad, 256-resized.shape[1]-w_pad)), 'constant',
-                           constant_values=y)
-                    for x, y in [(resized[..., 0], 1), (resized[..., 1], 0)]
-                ], axis=-1)
-
-                depth = normal[..., 0]
-                valid = depth < 1
-                depth[valid] = (depth[valid]-distr[2, 0])/distr[2, 1]*distr_in[2, 1]+distr_in[2, 0]
-                normal[..., 0] = depth
-
-                dset_out[i, angle] = normal
+        f = open_hdf5('data.hdf5', 'w')
+        dset_out = create_dataset(f, 'dset', dset.shape, access='angle', compress=True)
+
+        with multiprocessing.Pool(_get_pool_processes()) as p:
+            stats_in = np.stack(list(p.imap(_get_zone_stats, tqdm.tqdm(dset_in))))
+            synthetic_gen = (data[..., 0] for data in tqdm.tqdm(dset))
+            stats = np.stack(list(p.imap(_get_zone_stats, synthetic_gen)))
+            distr_in, distr = _get_zone_distributions(stats_in), _get_zone_distributions(stats)
+
+            args = ((data, stats[i], distr, distr_in) for i, data in enumerate(dset))
+            for i, normal in enumerate(tqdm.tqdm(p.imap(_normalize_synthetic_zone_images, args),
+                                                 total=len(dset))):
+                dset_out[i] = normal
 
         f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
+    f = open_hdf5('data.hdf5')
     dset_out = f['dset']
     return dset_out
 
@@ -319,8 +428,8 @@ def train_zone_segmentation_cnn(mode, duration, learning_rate=1e-3, stretch_amou
     angles, height, width, res, zones = 16, 330, 256, 256, 18
     tf.reset_default_graph()
 
-    data_in = tf.placeholder(tf.float32, [1, height, width, 2])
-    angle = tf.placeholder(tf.int32, [])
+    data_in = tf.placeholder(tf.float32, [None, height, width, 2])
+    angle = tf.placeholder(tf.int32, [None])
 
     # random resize
     size = tf.random_uniform([2], minval=int((1-stretch_amount)*res), maxval=res, dtype=tf.int32)
@@ -344,8 +453,9 @@ def train_zone_segmentation_cnn(mode, duration, learning_rate=1e-3, stretch_amou
 
     # get logits
     _, logits = tf_models.hourglass_cnn(data[..., :1], res, 4, res, 64, num_output=angles*zones)
-    logits = tf.reshape(logits, [1, res, res, angles, zones])
-    logits = logits[..., angle, :]
+    logits = tf.reshape(logits, [-1, res, res, angles, zones])
+    logits = tf.reduce_sum(logits * tf.reshape(tf.one_hot(angle, angles), [-1, 1, 1, angles, 1]),
+                           axis=3)
 
     # segmentation logloss
     loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.cast(data[..., 1], tf.int32),
@@ -365,20 +475,21 @@ def train_zone_segmentation_cnn(mode, duration, learning_rate=1e-3, stretch_amou
     saver = tf.train.Saver()
     model_path = os.getcwd() + '/model.ckpt'
 
-    def predict(gen, n_sample=64):
+    def predict(gen, n_sample=64, batch_size=16):
         with tf.Session() as sess:
             saver.restore(sess, model_path)
-            for cur_data in gen:
-                ret = np.zeros((angles, height, width, zones))
-                for i in range(angles):
-                    for _ in range(n_sample):
-                        feed_data = np.stack([cur_data[i:i+1], np.zeros((1,)+cur_data.shape[1:])],
-                                             axis=-1)
-                        ret[i:i+1] += sess.run(preds, feed_dict={
-                            data_in: feed_data,
-                            angle: i
-                        })
-                yield ret / n_sample
+
+            def predict_batch(images, cur_angles):
+                feed_data = np.stack([images, np.zeros(images.shape, dtype='float32')], axis=-1)
+                ret = np.zeros(images.shape + (zones,), dtype='float32')
+                for _ in range(n_sample):
+                    ret += sess.run(preds, feed_dict={
+                        data_in: feed_data,
+                        angle: cur_angles
+                    })
+                return ret / n_sample
+
+            yield from _predict_angle_batches(gen, predict_batch, batch_size)
 
     if os.path.exists('done'):
         return predict
@@ -400,7 +511,7 @@ def train_zone_segmentation_cnn(mode, duration, learning_rate=1e-3, stretch_amou
             for cur_data, cur_angle in batch_gen(dset_all):
                 _, cur_train_summary = sess.run([train_step, train_summary], feed_dict={
                     data_in: cur_data,
-                    angle: cur_angle
+                    angle: [cur_angle]
                 })
                 writer.add_summary(cur_train_summary, it)
                 it += 1
@@ -416,60 +527,48 @@ def train_zone_segmentation_cnn(mode, duration, learning_rate=1e-3, stretch_amou
     return predict
 
 
-def spatial_pool_zones(gen):
-    max_procs = multiprocessing.cpu_count()
-    batch = []
-    with read_input_dir('scripts'):
-        exe = os.getcwd() + '/spatial_pooling'
-    subprocess.call('rm *.in', shell=True)
-    subprocess.call('rm *.out', shell=True)
-
-    def flush_batch():
-        filenames = []
-        procs = []
-        for data in batch:
-            random_string = ''.join(random.choice(string.ascii_uppercase) for _ in range(64))
-            with open('%s.in' % random_string, 'wb') as f:
-                f.write(data.astype('float32').tobytes())
-            filenames.append(random_string)
-            proc = subprocess.Popen([exe, '%s.in' % random_string,
-                                     '%s.out' % random_string])
-            procs.append(proc)
-
-        ret = []
-        for proc, file in zip(procs, filenames):
-            retcode = proc.wait()
-            if retcode != 0:
-                raise Exception('failed to do spatial pooling')
-            data = np.fromfile('%s.out' % file, dtype='float32').reshape((16, 330, 256, 19))
-            subprocess.check_call(['rm', '%s.in' % file])
-            subprocess.check_call(['rm', '%s.out' % file])
-            ret.append(data[..., 1:])
-        batch.clear()
-        return ret
+def spatial_pool_zones(gen, per_channel=False):
+    """Spatially pooled zone channels of each hull; by default every channel is taken from the
+    rotated hull at the median depth, with per_channel the median of each channel separately.
+    """
+    batch_size = multiprocessing.cpu_count()
+    shape = (batch_size, spatial_pooling.A, spatial_pooling.N, spatial_pooling.M,
+             spatial_pooling.K)
+    hulls_in, hulls_out = np.zeros(shape, dtype='float32'), np.zeros(shape, dtype='float32')
+
+    def flush_batch(n):
+        spatial_pooling.spatial_pool_batch(hulls_in[:n], hulls_out[:n], per_channel)
+        return [hulls_out[i, ..., 1:].copy() for i in range(n)]
 
+    n = 0
     for data in gen:
-        batch.append(data)
-        if len(batch) == max_procs:
-            yield from flush_batch()
-    yield from flush_batch()
+        hulls_in[n] = data
+        n += 1
+        if n == batch_size:
+            yield from flush_batch(n)
+            n = 0
+    yield from flush_batch(n)
 
 
-@cached(train_zone_segmentation_cnn, get_depth_maps, subdir='ssd', cloud_cache=True, version=5)
+@cached(train_zone_segmentation_cnn, get_depth_maps, subdir='ssd', cloud_cache=True, version=6)
 def get_body_zones(mode):
     if not os.path.exists('done'):
         names, labels, dset_in = get_depth_maps(mode)
         predict = train_zone_segmentation_cnn('all', 0.25, stretch_amount=0.75, random_shift=0.1,
                                               random_scale=0.1, random_noise_z=2)
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(dset_in), 16, 330, 256, 18))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(dset_in), 16, 330, 256, 18), compress=True,
+                              precision=PRECISION_POLICY['body_zones'])
 
         def gen():
             for data, pred in zip(dset_in, predict(tqdm.tqdm(dset_in), 64)):
                 yield np.concatenate([data[..., np.newaxis], pred], axis=-1)
-        for i, pred in enumerate(spatial_pool_zones(gen())):
-            pred[np.sum(pred, axis=-1) == 0, 0] = 1e-6
-            dset[i] = pred
+
+        def pooled_gen():
+            for pred in spatial_pool_zones(gen()):
+                pred[np.sum(pred, axis=-1) == 0, 0] = 1e-6
+                yield pred
+        _write_chunks(dset, pooled_gen(), 4)
 
         f.close()
         with open('pkl', 'wb') as f:
@@ -478,6 +577,27 @@ def get_body_zones(mode):
 
     with open('pkl', 'rb') as f:
         names, labels = pickle.load(f)
-    f = h5py.File('data.hdf5', 'r')
-    dset = f['dset']
+    f = open_hdf5('data.hdf5')
+    dset = open_dataset(f, 'dset')
+    return names, labels, dset
+
+
+@cached(get_body_zones, subdir='ssd', cloud_cache=True, version=0)
+def get_compact_body_zones(mode, n_top=2):
+    if not os.path.exists('done'):
+        names, labels, dset_in = get_body_zones(mode)
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_compact_zones_dataset(f, 'dset', dset_in.shape, n_top)
+        for i, data in enumerate(tqdm.tqdm(dset_in)):
+            write_compact_zones(dset, i, data)
+
+        f.close()
+        with open('pkl', 'wb') as f:
+            pickle.dump((names, labels), f)
+        open('done', 'w').close()
+
+    with open('pkl', 'rb') as f:
+        names, labels = pickle.load(f)
+    f = open_hdf5('data.hdf5')
+    dset = open_dataset(f, 'dset')
     return names, labels, dset
@@ -1,16 +1,18 @@
 from common.caching import read_input_dir, cached
-from common.dataio import get_aps_data_hdf5, get_passenger_clusters
+from common.dataio import get_aps_data_hdf5, get_passenger_clusters, open_dataset, pack_mask, \
+                          create_packed_mask_dataset, create_sparse_dataset, write_sparse, \
+                          ChannelView, open_hdf5
 
 import numpy as np
 import skimage.transform
 import glob
 import os
 import tqdm
-import h5py
 import pickle
 import imageio
 import skimage.measure
 import cv2
+import multiprocessing
 
 
 SEGMENTATION_COLORS = np.array([[255, 0, 0], [255, 0, 255], [0, 0, 255]])
@@ -26,8 +28,8 @@ def _get_mask(image, color):
 def get_threat_heatmaps(mode):
     if not os.path.exists('done'):
         names, labels, x = get_aps_data_hdf5(mode)
-        f = h5py.File('data.hdf5', 'w')
-        th = f.create_dataset('th', x.shape + (3,))
+        f = open_hdf5('data.hdf5', 'w')
+        th = create_packed_mask_dataset(f, 'th', x.shape + (3,))
 
         with read_input_dir('hand_labeling/threat_segmentation/base'):
             for i, (name, label, data) in tqdm.tqdm(enumerate(zip(names, labels, x)), total=len(x)):
@@ -43,78 +45,97 @@ def get_threat_heatmaps(mode):
                         rimage = imageio.imread(revision)
                         masks[rci] = _get_mask(rimage, SEGMENTATION_COLORS[0])
 
-                th[i] = np.stack(masks, axis=-1)
+                th[i] = pack_mask(np.stack(masks, axis=-1))
 
+        f.close()
         open('done', 'w').close()
-    else:
-        f = h5py.File('data.hdf5', 'r')
-        th = f['th']
+
+    f = open_hdf5('data.hdf5')
+    th = open_dataset(f, 'th')
     return th
 
 
+def _segmentation_mask(masks):
+    ret = np.zeros((16, 660, 512, 2))
+    for i in range(16):
+        for j in range(3):
+            cur = masks[..., i, j]
+            if not cur.any():
+                continue
+            ret[i, ..., 0] += cur / np.max(cur)
+            ret[i, ..., 1] += cur / np.sum(cur)
+    return ret
+
+
+def _gaussian_window(center, size, sigma, radius):
+    center = min(max(center, 0), size-1)
+    i0 = max(0, int(center - radius*sigma))
+    i1 = min(size, int(center + radius*sigma) + 2)
+    return i0, i1
+
+
+def _com_mask(masks, sigma=4, radius=5):
+    # isotropic gaussian (covariance 16) is separable, and is negligible beyond a few sigma
+    ret = np.zeros((16, 660, 512, 2))
+    for i in range(16):
+        for j in range(3):
+            cur = masks[..., i, j]
+            if not cur.any():
+                continue
+            M = skimage.measure.moments(cur.astype('double'))
+            xb, yb = M[0, 1]/M[0, 0], M[1, 0]/M[0, 0]
+            y0, y1 = _gaussian_window(xb, 660, sigma, radius)
+            x0, x1 = _gaussian_window(yb, 512, sigma, radius)
+            gy = np.exp(-0.5*((np.arange(y0, y1)-xb)/sigma)**2)
+            gx = np.exp(-0.5*((np.arange(x0, x1)-yb)/sigma)**2)
+            ret[i, y0:y1, x0:x1, 0] += np.outer(gy/np.max(gy), gx/np.max(gx))
+            ret[i, y0:y1, x0:x1, 1] += np.outer(gy/np.sum(gy), gx/np.sum(gx))
+    return ret
+
+
+def _distance_mask(masks):
+    ret = np.zeros((16, 660, 512, 2))
+    for i in range(16):
+        for j in range(3):
+            cur = (masks[..., i, j]*255).astype('uint8')
+            if not cur.any():
+                continue
+            g = cv2.distanceTransform(cur, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            ret[i, ..., 0] += g / np.max(g)
+            ret[i, ..., 1] += g / np.sum(g)
+    return ret
+
+
+def _get_augmented_threat_heatmap(masks):
+    return np.concatenate([
+        _segmentation_mask(masks),
+        _com_mask(masks),
+        _distance_mask(masks)
+    ], axis=-1).astype('float32')
+
+
 @cached(get_threat_heatmaps, version=8, subdir='ssd', cloud_cache=True)
 def get_augmented_threat_heatmaps(mode):
     if not os.path.exists('done'):
         th_in = get_threat_heatmaps(mode)
-        f = h5py.File('data.hdf5', 'w')
-        th = f.create_dataset('th', (len(th_in), 16, 660, 512, 6))
-
-        def segmentation_mask(masks):
-            ret = np.zeros((16, 660, 512, 2))
-            for i in range(16):
-                for j in range(3):
-                    cur = masks[..., i, j]
-                    if not cur.any():
-                        continue
-                    ret[i, ..., 0] += cur / np.max(cur)
-                    ret[i, ..., 1] += cur / np.sum(cur)
-            return ret
-
-        def com_mask(masks):
-            ret = np.zeros((16, 660, 512, 2))
-            for i in range(16):
-                for j in range(3):
-                    cur = masks[..., i, j]
-                    if not cur.any():
-                        continue
-                    M = skimage.measure.moments(cur.astype('double'))
-                    xb, yb = M[0, 1]/M[0, 0], M[1, 0]/M[0, 0]
-                    cov = np.array([[16, 0], [0, 16]])
-                    covinv = np.linalg.inv(cov)
-                    mean = np.array([xb, yb])
-                    gx, gy = np.meshgrid(np.arange(512), np.arange(660))
-                    g = np.reshape(np.stack([gy, gx], axis=-1), (-1, 2))
-                    g = np.exp(-0.5*np.sum((g-mean).dot(covinv)*(g-mean), axis=1))
-                    g = np.reshape(g, (660, 512))
-                    ret[i, ..., 0] += g / np.max(g)
-                    ret[i, ..., 1] += g / np.sum(g)
-            return ret
-
-        def distance_mask(masks):
-            ret = np.zeros((16, 660, 512, 2))
-            for i in range(16):
-                for j in range(3):
-                    cur = (masks[..., i, j]*255).astype('uint8')
-                    if not cur.any():
-                        continue
-                    g = cv2.distanceTransform(cur, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
-                    ret[i, ..., 0] += g / np.max(g)
-                    ret[i, ..., 1] += g / np.sum(g)
-            return ret
+        f = open_hdf5('data.hdf5', 'w')
+        th = create_sparse_dataset(f, 'th', (len(th_in), 16, 660, 512, 6))
 
         mean = np.zeros(6)
-        for i, data in enumerate(tqdm.tqdm(th_in)):
-            th[i, ..., 0:2] = segmentation_mask(data)
-            th[i, ..., 2:4] = com_mask(data)
-            th[i, ..., 4:6] = distance_mask(data)
-            mean += np.mean(th[i], axis=(0, 1, 2)) / len(th)
+        batch_size = multiprocessing.cpu_count()
+        with multiprocessing.Pool(batch_size) as p:
+            for i1 in tqdm.trange(0, len(th_in), batch_size):
+                batch = p.map(_get_augmented_threat_heatmap, th_in[i1:i1+batch_size])
+                for i, data in enumerate(batch, i1):
+                    write_sparse(th, i, data)
+                    mean += np.mean(data, axis=(0, 1, 2)) / len(th_in)
 
         np.save('mean.npy', mean)
         f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
-    th = f['th']
+    f = open_hdf5('data.hdf5')
+    th = open_dataset(f, 'th')
     mean = np.load('mean.npy')
     return th, mean
 
@@ -122,17 +143,8 @@ def get_augmented_threat_heatmaps(mode):
 @cached(get_aps_data_hdf5, get_threat_heatmaps, version=0, subdir='ssd')
 def get_data_and_threat_heatmaps(mode):
     names, labels, x = get_aps_data_hdf5(mode)
-    if not os.path.exists('done'):
-        th = get_threat_heatmaps(mode)
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', x.shape + (4,))
-        for i, (data, hmap) in tqdm.tqdm(enumerate(zip(x, th)), total=len(x)):
-            dset[i] = np.concatenate([data[..., np.newaxis], hmap], axis=-1)
-        open('done', 'w').close()
-    else:
-        f = h5py.File('data.hdf5', 'r')
-        dset = f['dset']
-    return names, labels, dset
+    th = get_threat_heatmaps(mode)
+    return names, labels, ChannelView([x, th])
 
 
 @cached(get_data_and_threat_heatmaps, version=0)
@@ -1,46 +1,50 @@
 from common.caching import read_input_dir, cached
-from common.dataio import get_aps_data_hdf5, get_passenger_clusters, get_data
+from common.dataio import get_aps_data_hdf5, get_passenger_clusters, get_data, ConcatenatedView, \
+                          PermutedView, create_dataset, open_hdf5
+from common.workqueue import WorkQueue
+from common.registration import ElastixBackend, DemonsBackend, REGISTRATION_BACKENDS, \
+                                get_registration_store
 
 from . import dataio
 
 import tensorflow as tf
 import numpy as np
 import skimage.transform
+import sklearn.decomposition
+import sklearn.neighbors
+import scipy.optimize
 import glob
 import os
 import tqdm
-import h5py
 import pickle
 import imageio
 import time
+import collections
 import multiprocessing
 import common.pyelastix
 import heapq
+import threading
+import logging
 
 
 @cached(get_passenger_clusters, dataio.get_data_and_threat_heatmaps, version=0, subdir='ssd')
 def get_clustered_data_and_threat_heatmaps(mode, cluster_type):
     assert cluster_type in ('groundtruth')
 
+    names_in, labels_in, dset_in = dataio.get_data_and_threat_heatmaps(mode)
+    names_in_idx = {name: i for i, name in enumerate(names_in)}
     if not os.path.exists('done'):
         clusters = get_passenger_clusters()
 
-        names_in, labels_in, dset_in = dataio.get_data_and_threat_heatmaps(mode)
         clusters = [[y for y in x if y in names_in] for x in clusters]
         clusters = [x for x in clusters if x]
         names = sum(clusters, [])
-        names_in_idx = {name: i for i, name in enumerate(names_in)}
         perm = [names_in_idx[name] for name in names]
         labels = np.stack([labels_in[i] for i in perm])
         ranges = [(0, len(x)) for x in clusters]
         for i in range(1, len(ranges)):
             ranges[i] = (ranges[i][0]+ranges[i-1][1], ranges[i][1]+ranges[i-1][1])
 
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', dset_in.shape)
-        for i in tqdm.trange(len(dset)):
-            dset[i] = dset_in[perm[i]]
-
         with open('pkl', 'wb') as f:
             pickle.dump((ranges, names), f)
         np.save('labels.npy', labels)
@@ -49,8 +53,7 @@ def get_clustered_data_and_threat_heatmaps(mode, cluster_type):
         with open('pkl', 'rb') as f:
             ranges, names = pickle.load(f)
         labels = np.load('labels.npy')
-        f = h5py.File('data.hdf5', 'r')
-        dset = f['dset']
+    dset = PermutedView(dset_in, [names_in_idx[name] for name in names])
     return ranges, names, labels, dset
 
 
@@ -67,64 +70,214 @@ def get_passenger_groups(mode):
     return group
 
 
-@cached(get_aps_data_hdf5, cloud_cache=True, version=3)
-def get_distance_matrix(mode):
+@cached(get_aps_data_hdf5, subdir='ssd', version=0)
+def get_pyramid_features(mode):
     if not os.path.exists('done'):
         batch_size = 32
 
         tf.reset_default_graph()
-        x1_in = tf.placeholder(tf.float32, [None, 660, 512, 16])
-        x2_in = tf.placeholder(tf.float32, [None, 660, 512, 16])
-        dist_mats = []
+        x_in = tf.placeholder(tf.float32, [None, 660, 512, 16])
+        feats = []
 
         for feat in range(3):
             res = 512
             if feat == 0:
-                x1, x2 = x1_in, x2_in
+                x = x_in
             elif feat == 1:
-                x1, x2 = x1_in[:, :330, :, :], x2_in[:, :330, :, :]
+                x = x_in[:, :330, :, :]
             else:
-                x1, x2 = x1_in[:, :, 128:384, :], x2_in[:, :, 128:384, :]
-            x1 = tf.image.resize_images(x1, [res, res])
-            x2 = tf.image.resize_images(x2, [res, res])
+                x = x_in[:, :, 128:384, :]
+            x = tf.image.resize_images(x, [res, res])
 
             for _ in range(9):
-                n = 16 * res**2
-                x1_v = tf.reshape(x1, [-1, n])
-                x2_v = tf.transpose(tf.reshape(x2, [-1, n]))
-                dots = tf.matmul(x1_v, x2_v)
-                diff = tf.reduce_sum(tf.square(x1_v), axis=1, keep_dims=True) - 2*dots + \
-                       tf.reduce_sum(tf.square(x2_v), axis=0, keep_dims=True)
-
-                dist = tf.sqrt(tf.maximum(diff/n, 0))
-                dist_mats.append(dist)
-
+                feats.append(tf.reshape(x, [-1, 16 * res**2]))
                 res //= 2
-                x1 = tf.image.resize_images(x1, [res, res])
-                x2 = tf.image.resize_images(x2, [res, res])
-
-        dist_mat = tf.stack(dist_mats, axis=-1)
+                x = tf.image.resize_images(x, [res, res])
 
         _, _, dset = get_aps_data_hdf5(mode)
-        dmat = np.zeros((len(dset), len(dset), 27))
+        f = open_hdf5('data.hdf5', 'w')
+        out = [create_dataset(f, 'feat%s' % k, (len(dset), int(feat.shape[1])))
+               for k, feat in enumerate(feats)]
+        norms = np.zeros((len(dset), len(feats)))
         with tf.Session() as sess:
             for i in tqdm.trange(0, len(dset), batch_size):
-                for j in tqdm.trange(0, len(dset), batch_size):
-                    mat = sess.run(dist_mat, feed_dict={
-                        x1_in: dset[i:i+batch_size],
-                        x2_in: dset[j:j+batch_size]
-                    })
-                    dmat[i:i+batch_size, j:j+batch_size, :] = mat
-
-        np.save('dmat.npy', dmat)
+                cur_feats = sess.run(feats, feed_dict={x_in: dset[i:i+batch_size]})
+                for k, feat in enumerate(cur_feats):
+                    out[k][i:i+batch_size] = feat
+                    norms[i:i+batch_size, k] = np.sum(np.square(feat, dtype='float64'), axis=1)
+
+        np.save('norms.npy', norms)
+        f.close()
         open('done', 'w').close()
-    else:
-        dmat = np.load('dmat.npy')
+
+    f = open_hdf5('data.hdf5')
+    feats = [f['feat%s' % k] for k in range(27)]
+    norms = np.load('norms.npy')
+    return feats, norms
+
+
+@cached(get_pyramid_features, cloud_cache=True, version=4)
+def get_distance_matrix(mode):
+    if not os.path.exists('done'):
+        max_block_bytes = 1 << 32
+        feats, norms = get_pyramid_features(mode)
+        n = len(norms)
+
+        dmat = np.lib.format.open_memmap('dmat.npy', mode='w+', dtype='float32',
+                                         shape=(n, n, len(feats)))
+        for k, feat in enumerate(tqdm.tqdm(feats)):
+            dim = feat.shape[1]
+            block_size = max(1, min(n, max_block_bytes // (4*dim)))
+            for i in range(0, n, block_size):
+                x1 = feat[i:i+block_size]
+                # symmetric, so only blocks on or above the diagonal; BLAS spreads each over cores
+                for j in range(i, n, block_size):
+                    x2 = x1 if j == i else feat[j:j+block_size]
+                    dots = np.dot(x1, x2.T)
+                    diff = norms[i:i+block_size, k, np.newaxis] - 2*dots + \
+                           norms[np.newaxis, j:j+block_size, k]
+                    dist = np.sqrt(np.maximum(diff/dim, 0))
+                    dmat[i:i+block_size, j:j+block_size, k] = dist
+                    dmat[j:j+block_size, i:i+block_size, k] = dist.T
+
+        dmat.flush()
+        del dmat
+        open('done', 'w').close()
+
+    dmat = np.load('dmat.npy', mmap_mode='r')
     return dmat
 
 
-@cached(get_aps_data_hdf5, get_distance_matrix, cloud_cache=True, version=0)
-def train_clustering_model(mode, duration):
+def _get_cluster_ids(names):
+    """Cluster index of each scan, or -1 for scans in no passenger cluster."""
+    name_idx = {x: i for i, x in enumerate(names)}
+    cluster_ids = -np.ones(len(names), dtype='int64')
+    for k, cluster in enumerate(get_passenger_clusters()):
+        for name in cluster:
+            cluster_ids[name_idx[name]] = k
+    return cluster_ids
+
+
+def _get_pair_labels(cluster_ids, rows, cols):
+    """Broadcast rows against cols, labelling pairs from the same passenger cluster with 1."""
+    same = cluster_ids[rows] == cluster_ids[cols]
+    return np.logical_and(same, cluster_ids[rows] >= 0).astype('float64')
+
+
+def _iterate_row_blocks(n, block_rows):
+    for i in range(0, n, block_rows):
+        yield np.arange(i, min(n, i+block_rows))
+
+
+def _get_pair_moments(dmat, block_rows):
+    """Mean and variance over all pairs and features, streamed over blocks of rows."""
+    total, total_sq = 0, 0
+    for rows in _iterate_row_blocks(len(dmat), block_rows):
+        x = np.asarray(dmat[rows[0]:rows[-1]+1], dtype='float64')
+        total, total_sq = total + np.sum(x), total_sq + np.sum(np.square(x))
+    count = dmat.shape[0] * dmat.shape[1] * dmat.shape[2]
+    mean = total / count
+    return mean, total_sq / count - mean**2
+
+
+def _logistic_loss(w, x, labels, weights):
+    """Weighted mean logistic loss and its gradient; the last entry of w is the bias."""
+    logits = np.dot(x, w[:-1]) + w[-1]
+    loss = np.sum(weights * (np.logaddexp(0, logits) - labels * logits)) / np.sum(weights)
+    err = weights * (1 / (1 + np.exp(-logits)) - labels) / np.sum(weights)
+    return loss, np.append(np.dot(err, x), np.sum(err))
+
+
+def _train_clustering_lbfgs(dmat, cluster_ids, mean, std, n_pairs):
+    """Fit on every positive pair and a fixed random subsample of negatives, weighting the
+    negatives so the objective matches the mean loss over all pairs."""
+    n = len(dmat)
+    rng = np.random.RandomState(0)
+    pos = [np.meshgrid(idx, idx) for idx in
+           (np.nonzero(cluster_ids == k)[0] for k in np.unique(cluster_ids[cluster_ids >= 0]))]
+    pos_i = np.concatenate([np.ravel(x[1]) for x in pos] + [np.zeros(0, dtype='int64')])
+    pos_j = np.concatenate([np.ravel(x[0]) for x in pos] + [np.zeros(0, dtype='int64')])
+    n_neg = n*n - len(pos_i)
+    neg_i, neg_j = rng.randint(n, size=n_pairs), rng.randint(n, size=n_pairs)
+    keep = _get_pair_labels(cluster_ids, neg_i, neg_j) == 0
+    neg_i, neg_j = neg_i[keep], neg_j[keep]
+
+    rows, cols = np.concatenate([pos_i, neg_i]), np.concatenate([pos_j, neg_j])
+    x = (np.asarray(dmat[rows, cols], dtype='float64') - mean) / std
+    labels = np.append(np.ones(len(pos_i)), np.zeros(len(neg_i)))
+    weights = np.append(np.ones(len(pos_i)), np.full(len(neg_i), n_neg / max(len(neg_i), 1)))
+
+    result = scipy.optimize.minimize(_logistic_loss, np.zeros(x.shape[1] + 1),
+                                     args=(x, labels, weights), jac=True, method='L-BFGS-B')
+    return result.x
+
+
+def _train_clustering_minibatch(dmat, cluster_ids, mean, std, duration, block_rows):
+    """Adam over contiguous blocks of distance matrix rows, visited in a new random order each
+    epoch, so memory only grows with n and the memmapped distances are read sequentially.
+    """
+    n = len(dmat)
+    rng = np.random.RandomState(0)
+    w = np.zeros(dmat.shape[2] + 1)
+    m, v = np.zeros_like(w), np.zeros_like(w)
+    lr, beta1, beta2, eps = 1e-3, 0.9, 0.999, 1e-8
+    t, t0 = 0, time.time()
+    while time.time() - t0 < duration * 3600:
+        for i in rng.permutation(np.arange(0, n, block_rows)):
+            rows = np.arange(i, min(n, i+block_rows))
+            x = np.asarray(dmat[i:i+block_rows], dtype='float64').reshape(-1, dmat.shape[2])
+            x = (x - mean) / std
+            labels = _get_pair_labels(cluster_ids, rows[:, np.newaxis], np.arange(n)).reshape(-1)
+            _, grad = _logistic_loss(w, x, labels, np.ones(len(labels)))
+
+            t += 1
+            m = beta1*m + (1-beta1)*grad
+            v = beta2*v + (1-beta2)*np.square(grad)
+            w -= lr * (m/(1-beta1**t)) / (np.sqrt(v/(1-beta2**t)) + eps)
+            if time.time() - t0 >= duration * 3600:
+                break
+    return w
+
+
+@cached(get_aps_data_hdf5, get_distance_matrix, cloud_cache=True, version=1)
+def train_clustering_model(mode, duration, solver='adam', n_pairs=1<<22, block_rows=64):
+    """Logistic model for whether two scans are the same passenger.
+
+    The default 'adam' solver runs full-batch Adam on every pair for duration hours. 'lbfgs'
+    fits the same model on a subsample of n_pairs pairs to convergence, and 'minibatch' runs
+    Adam for duration hours on blocks of block_rows rows read from the memmapped distances.
+
+    The adam model standardizes each input by its own moments, which only matches training when
+    scoring a whole distance matrix; predict(x, global_moments=True) uses the moments of the
+    training distances instead, so scores of small sets of pairs are comparable.
+    """
+    assert solver in ('adam', 'lbfgs', 'minibatch')
+    if solver != 'adam':
+        model_dir = os.getcwd()
+
+        def predict(x, global_moments=True):
+            w, mean, std = [np.load('%s/%s.npy' % (model_dir, name))
+                            for name in ('model', 'mean', 'std')]
+            x = (np.reshape(x, (-1, len(w)-1)) - mean) / std
+            return -np.logaddexp(0, -(np.dot(x, w[:-1]) + w[-1]))
+
+        if not os.path.exists('done'):
+            dmat_train = get_distance_matrix(mode)
+            names, _, _ = get_aps_data_hdf5(mode)
+            cluster_ids = _get_cluster_ids(names)
+            mean, var = _get_pair_moments(dmat_train, block_rows)
+            std = np.sqrt(var)
+            if solver == 'lbfgs':
+                w = _train_clustering_lbfgs(dmat_train, cluster_ids, mean, std, n_pairs)
+            else:
+                w = _train_clustering_minibatch(dmat_train, cluster_ids, mean, std, duration,
+                                                block_rows)
+            np.save('model.npy', w)
+            np.save('mean.npy', mean)
+            np.save('std.npy', std)
+            open('done', 'w').close()
+        return predict
+
     tf.reset_default_graph()
 
     dmat_in = tf.placeholder(tf.float32, [None, None, 27])
@@ -143,11 +296,20 @@ def train_clustering_model(mode, duration):
 
     saver = tf.train.Saver()
     model_path = os.getcwd() + '/model.ckpt'
+    moments_path = os.getcwd() + '/moments.npy'
+
+    def get_moments():
+        if not os.path.exists(moments_path):
+            np.save(moments_path, _get_pair_moments(get_distance_matrix(mode), block_rows))
+        return np.load(moments_path)
 
-    def predict(x):
+    def predict(x, global_moments=False):
+        feed_dict = {dmat_in: x}
+        if global_moments:
+            feed_dict[mean], feed_dict[var] = get_moments()
         with tf.Session() as sess:
             saver.restore(sess, model_path)
-            return sess.run(logprob, feed_dict={dmat_in: x})
+            return sess.run(logprob, feed_dict=feed_dict)
 
     if os.path.exists('done'):
         return predict
@@ -175,6 +337,7 @@ def train_clustering_model(mode, duration):
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
         train_model(sess, duration)
+    get_moments()
     open('done', 'w').close()
 
     return predict
@@ -223,6 +386,251 @@ def get_candidate_neighbors(mode, min_neighbors):
     return cand
 
 
+# pyramid levels at 32x32 and below, small enough to embed every scan
+EMBEDDING_LEVELS = [feat*9 + level for feat in range(3) for level in range(4, 9)]
+
+
+def _get_embedding_features(feats, i1, i2):
+    # scaled so squared euclidean distance is the sum of squared per-level distances
+    return np.concatenate([feats[k][i1:i2] / np.sqrt(feats[k].shape[1])
+                           for k in EMBEDDING_LEVELS], axis=1)
+
+
+def _embed_scans(feats, embed, batch_size=64):
+    n = len(feats[0])
+    return np.concatenate([embed(_get_embedding_features(feats, i, i+batch_size))
+                           for i in range(0, n, batch_size)])
+
+
+def _get_pair_distances(feats1, norms1, rows, feats2, norms2, cols, max_block_bytes=1 << 32):
+    dist = np.zeros((len(rows), len(cols), len(feats1)), dtype='float32')
+    for k, (feat1, feat2) in enumerate(zip(feats1, feats2)):
+        dim = feat1.shape[1]
+        block_size = max(1, max_block_bytes // (4*dim))
+        x1 = feat1[rows[0]:rows[-1]+1]
+        for j in range(0, len(cols), block_size):
+            idx = cols[j:j+block_size]
+            diff = norms1[rows, k, np.newaxis] - 2*np.dot(x1, feat2[idx].T) + \
+                   norms2[np.newaxis, idx, k]
+            dist[:, j:j+block_size, k] = np.sqrt(np.maximum(diff/dim, 0))
+    return dist
+
+
+@cached(get_pyramid_features, version=0)
+def train_embedding_model(mode, n_components):
+    if not os.path.exists('done'):
+        feats, norms = get_pyramid_features(mode)
+        pca = sklearn.decomposition.PCA(n_components, random_state=0)
+        pca.fit(_get_embedding_features(feats, 0, len(norms)))
+
+        np.save('mean.npy', pca.mean_)
+        np.save('components.npy', pca.components_)
+        open('done', 'w').close()
+
+    mean, components = np.load('mean.npy'), np.load('components.npy')
+
+    def embed(x):
+        return np.dot(x - mean, components.T)
+
+    return embed
+
+
+@cached(get_pyramid_features, train_embedding_model, train_clustering_model, cloud_cache=True,
+        version=1)
+def get_approximate_candidate_neighbors(mode, min_neighbors):
+    if not os.path.exists('done'):
+        batch_size = 64
+        feats, norms = get_pyramid_features(mode)
+        n = len(norms)
+        n_search = min(n, min_neighbors * int(np.log2(n) + 1))
+        embed = train_embedding_model('all', 64)
+        predict = train_clustering_model('all', 1)
+
+        emb = _embed_scans(feats, embed)
+        tree = sklearn.neighbors.BallTree(emb)
+        _, search = tree.query(emb, k=n_search)
+
+        # rerank each block of queries by the clustering model on exact distances
+        perm = np.zeros((n, n_search), dtype=int)
+        conf = np.zeros(n)
+        for i in tqdm.trange(0, n, batch_size):
+            rows = np.arange(i, min(n, i+batch_size))
+            cols = np.unique(search[rows])
+            col_idx = {x: j for j, x in enumerate(cols)}
+            dist = _get_pair_distances(feats, norms, rows, feats, norms, cols)
+            for r in rows:
+                cand = search[r]
+                pvec = predict(dist[r-i, [col_idx[x] for x in cand]][np.newaxis],
+                               global_moments=True)
+                pvec = np.reshape(pvec, -1)
+                order = np.argsort(-pvec)
+                perm[r] = cand[order]
+                conf[r] = np.sum(pvec[order[:min_neighbors]])
+        order = np.argsort(conf)
+
+        cand = [[] for _ in range(n)]
+        for i in range(n):
+            n_cand = min(n_search, min_neighbors * int(-np.log2((i+1)/n) + 1))
+            cand[order[i]] = list(perm[order[i], :n_cand])
+
+        with open('pkl', 'wb') as f:
+            pickle.dump(cand, f)
+        open('done', 'w').close()
+    else:
+        with open('pkl', 'rb') as f:
+            cand = pickle.load(f)
+    return cand
+
+
+class ReferenceIndex(object):
+    """Embeddings of already-processed scans, keyed by (mode, index, name)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.emb = np.load('%s/emb.npy' % path)
+        with open('%s/entries.pkl' % path, 'rb') as f:
+            self.entries = pickle.load(f)
+        self._tree = None
+
+    @classmethod
+    def create(cls, path, emb, entries):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        cls._save(path, emb, entries)
+        return cls(path)
+
+    @staticmethod
+    def _save(path, emb, entries):
+        with open('%s/emb.npy.tmp' % path, 'wb') as f:
+            np.save(f, emb)
+        with open('%s/entries.pkl.tmp' % path, 'wb') as f:
+            pickle.dump(entries, f)
+        os.rename('%s/emb.npy.tmp' % path, '%s/emb.npy' % path)
+        os.rename('%s/entries.pkl.tmp' % path, '%s/entries.pkl' % path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, emb, k):
+        if self._tree is None:
+            self._tree = sklearn.neighbors.BallTree(self.emb)
+        dist, idx = self._tree.query(emb, k=min(k, len(self)))
+        return dist, [[self.entries[j] for j in row] for row in idx]
+
+    def insert(self, mode, names, emb):
+        known = {x[2] for x in self.entries}
+        keep = [i for i, name in enumerate(names) if name not in known]
+        if not keep:
+            return
+        self.emb = np.concatenate([self.emb, emb[keep]])
+        self.entries = self.entries + [(mode, i, names[i]) for i in keep]
+        self._save(self.path, self.emb, self.entries)
+        self._tree = None
+
+
+@cached(get_aps_data_hdf5, get_pyramid_features, train_embedding_model, version=0)
+def get_reference_index(mode):
+    if not os.path.exists('done'):
+        names, _, _ = get_aps_data_hdf5(mode)
+        feats, _ = get_pyramid_features(mode)
+        emb = _embed_scans(feats, train_embedding_model('all', 64))
+        ReferenceIndex.create('index', emb, [(mode, i, name) for i, name in enumerate(names)])
+        open('done', 'w').close()
+
+    return ReferenceIndex(os.getcwd() + '/index')
+
+
+def _open_reference_index(ref_mode, index_dir):
+    """The index of ref_mode, or a copy of it in index_dir that new scans are inserted into."""
+    index = get_reference_index(ref_mode)
+    if index_dir is None:
+        return index
+    if not os.path.exists('%s/entries.pkl' % index_dir):
+        return ReferenceIndex.create(index_dir, index.emb, index.entries)
+    return ReferenceIndex(index_dir)
+
+
+@cached(get_reference_index, get_aps_data_hdf5, get_pyramid_features, train_embedding_model,
+        train_clustering_model, version=2)
+def get_reference_candidate_neighbors(mode, ref_mode, n_candidates, index_dir=None):
+    """Candidates of every scan of mode among the indexed scans and the other scans of mode.
+
+    Returns (modes, cand), with cand[i] indexing the scans of modes concatenated in order. If
+    index_dir is given, the index of ref_mode is copied there on first use and the scans of mode
+    are inserted into it afterwards; the index in the cache is never modified.
+    """
+    if not os.path.exists('done'):
+        batch_size = 64
+        n_search = 4*n_candidates
+        index = _open_reference_index(ref_mode, index_dir)
+        names, _, _ = get_aps_data_hdf5(mode)
+        feats, norms = get_pyramid_features(mode)
+        n = len(names)
+        emb = _embed_scans(feats, train_embedding_model('all', 64))
+        predict = train_clustering_model('all', 1)
+
+        # scans of mode come from the batch itself, so they are candidates for each other even
+        # before being inserted, and index entries of the same scans are skipped
+        known = set(names)
+        ref_dist, ref_search = index.query(emb, n_search + n)
+        self_dist, self_idx = sklearn.neighbors.BallTree(emb).query(emb, k=min(n, n_search+1))
+        search = []
+        for r in range(n):
+            found = [(d, x[:2]) for d, x in zip(ref_dist[r], ref_search[r]) if x[2] not in known]
+            found += [(d, (mode, j)) for d, j in zip(self_dist[r], self_idx[r]) if j != r]
+            search.append([x for _, x in sorted(found)[:n_search]])
+
+        cand = []
+        for i in tqdm.trange(0, n, batch_size):
+            rows = np.arange(i, min(n, i+batch_size))
+            col_dist = {}
+            for ref in set(x[0] for r in rows for x in search[r]):
+                cols = np.unique([x[1] for r in rows for x in search[r] if x[0] == ref])
+                ref_feats, ref_norms = get_pyramid_features(ref)
+                dist = _get_pair_distances(feats, norms, rows, ref_feats, ref_norms, cols)
+                for j, col in enumerate(cols):
+                    col_dist[ref, col] = dist[:, j]
+            for r in rows:
+                dist = np.stack([col_dist[x][r-i] for x in search[r]])
+                pvec = np.reshape(predict(dist[np.newaxis], global_moments=True), -1)
+                order = np.argsort(-pvec)[:n_candidates]
+                cand.append([search[r][j] for j in order])
+
+        modes = [mode] + sorted(set(x[0] for row in cand for x in row) - {mode})
+        offsets = {m: 0 for m in modes}
+        for m1, m2 in zip(modes[:-1], modes[1:]):
+            offsets[m2] = offsets[m1] + len(get_aps_data_hdf5(m1)[0])
+        cand = [[offsets[m] + j for m, j in row] for row in cand]
+
+        if index_dir is not None:
+            index.insert(mode, names, emb)
+
+        with open('pkl', 'wb') as f:
+            pickle.dump((modes, cand), f)
+        open('done', 'w').close()
+    else:
+        with open('pkl', 'rb') as f:
+            modes, cand = pickle.load(f)
+    return modes, cand
+
+
+@cached(get_candidate_neighbors, get_approximate_candidate_neighbors, version=0)
+def get_candidate_neighbors_recall(mode, min_neighbors):
+    exact = get_candidate_neighbors(mode, min_neighbors)
+    approx = get_approximate_candidate_neighbors(mode, min_neighbors)
+
+    top_k, all_k = [], []
+    for x, y in zip(exact, approx):
+        top_k.append(len(set(x[:min_neighbors]) & set(y[:min_neighbors])) / min_neighbors)
+        all_k.append(len(set(x) & set(y)) / len(x))
+
+    with open('recall.txt', 'w') as f:
+        f.write('recall@%s: %s\n' % (min_neighbors, np.mean(top_k)))
+        f.write('candidate recall: %s\n' % np.mean(all_k))
+        f.write('worst candidate recall: %s\n' % np.min(all_k))
+    return np.mean(top_k), np.mean(all_k)
+
+
 def _scale_image(im1, im2):
     x, y = np.reshape(im1, (-1)), np.reshape(im2, (-1))
     a = np.vstack([x, np.ones(len(x))]).T
@@ -230,72 +638,420 @@ def _scale_image(im1, im2):
     return im1*m + c, res
 
 
-def _register_images(args):
-    im1, im2, params = args
-    reg, _ = common.pyelastix.register(im1, im2, params, verbose=0)
-    return _scale_image(reg, im2)
+def _register_batch(args):
+    backend, im1, im2, timeout = args
+    reg = backend.register(im1, im2, timeout=timeout)
+    reg = [_scale_image(x, y) for x, y in zip(reg, im2)]
+    return [(warped.astype('float32'), residual) for warped, residual in reg]
+
+
+def _get_registration_params():
+    params = common.pyelastix.get_default_params()
+    params.FinalGridSpacingInPhysicalUnits = 32
+    params.NumberOfResolutions = 4
+    params.MaximumNumberOfIterations = 64
+    return params
+
+
+def _get_coarse_registration_params():
+    params = _get_registration_params()
+    params.FinalGridSpacingInPhysicalUnits = 32 // COARSE_FACTOR
+    params.NumberOfResolutions = 2
+    params.MaximumNumberOfIterations = 16
+    return params
+
+
+def get_registration_backend(backend='elastix', stacked=False, params=None):
+    if backend == 'elastix':
+        return ElastixBackend(params or _get_registration_params(), stacked=stacked)
+    return REGISTRATION_BACKENDS[backend]()
+
+
+def _get_coarse_backend(backend):
+    if isinstance(backend, ElastixBackend):
+        return ElastixBackend(_get_coarse_registration_params(), stacked=backend.stacked)
+    return DemonsBackend(levels=2, iterations=16)
+
+
+def _downsample(im, factor):
+    h, w = im.shape[0] // factor, im.shape[1] // factor
+    return np.mean(np.reshape(im[:h*factor, :w*factor], (h, factor, w, factor)), axis=(1, 3))
+
+
+class _PendingRegistration(object):
+    """A task retried when it fails or has not finished within twice its own timeout. Polling
+    never blocks, so a failing task is resubmitted without holding up other scans.
+    """
+
+    def __init__(self, pool, fn, args, timeout, keys=None, digest=None):
+        self._pool, self._fn, self._args, self._timeout = pool, fn, args, timeout
+        self._keys, self._digest = keys, digest
+        self._tries = 0
+        self._value = None
+        self._submit()
 
+    def _submit(self):
+        self._tries += 1
+        self._pool._throttle()
+        self._deadline = time.time() + 2*self._timeout
+        self._result = self._pool._pool.apply_async(self._fn, (self._args,),
+                                                    callback=self._pool._task_done,
+                                                    error_callback=self._pool._task_done)
 
-def register_images(im1, im2, params=None):
-    if params is None:
-        params = common.pyelastix.get_default_params()
-        params.FinalGridSpacingInPhysicalUnits = 32
-        params.NumberOfResolutions = 4
-        params.MaximumNumberOfIterations = 64
-    if isinstance(im1, list):
-        if not isinstance(im2, list):
-            im2 = [im2 for _ in range(len(im1))]
-        for _ in range(10):
+    def _retry(self, reason):
+        logging.warning('registration try %s/%s failed: %s', self._tries, self._pool.retries,
+                        reason)
+        if self._tries >= self._pool.retries:
+            raise Exception('failed to register images')
+        self._submit()
+
+    def ready(self):
+        """Whether the value is available, resubmitting the task if it failed or timed out."""
+        if self._value is not None:
+            return True
+        if self._result.ready():
             try:
-                with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
-                    return p.map(_register_images, [(i1, i2, params) for i1, i2 in zip(im1, im2)])
+                value = self._result.get(0)
             except Exception as e:
-                print(e)
-        raise Exception('failed to register images')
+                self._retry(repr(e))
+                return False
+            if self._keys is not None:
+                for key, (warped, residual) in zip(self._keys, value):
+                    self._pool.store.put(key, self._digest, warped, residual)
+            self._value = value
+            return True
+        if time.time() > self._deadline:
+            self._retry('timed out after %s s' % (2*self._timeout))
+        return False
+
+    def get(self):
+        while not self.ready():
+            self._result.wait(max(self._deadline - time.time(), 0))
+        return self._value
+
+
+class _PendingSlice(object):
+    def __init__(self, stack, i):
+        self._stack, self._i = stack, i
+
+    def ready(self):
+        return self._stack.ready()
+
+    def get(self):
+        return self._stack.get()[self._i]
+
+
+class _StoredRegistration(object):
+    def __init__(self, value):
+        self._value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self._value
+
+
+class RegistrationPool(object):
+    """Long-lived registration worker pool; each task is retried and timed out on its own.
+
+    Backends that register a whole batch at once (stacked elastix, demons) get one task per
+    submission, otherwise each slice is its own task. Submissions with keys of the form
+    (moving, fixed, angle, modality) are read from and written to the registration store.
+    With max_in_flight, submitting blocks while that many tasks are queued or running.
+    """
+
+    def __init__(self, processes=None, retries=10, timeout=300, stacked=False,
+                 backend='elastix', max_in_flight=None):
+        self.retries, self.timeout, self.max_in_flight = retries, timeout, max_in_flight
+        self.backend = get_registration_backend(backend, stacked)
+        self.store = get_registration_store()
+        self._pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+        self._in_flight = 0
+        self._done = threading.Condition()
+
+    def _task_done(self, _):
+        # only counts tasks, so finished results are freed as soon as their caller drops them
+        with self._done:
+            self._in_flight -= 1
+            self._done.notify()
+
+    def _throttle(self):
+        with self._done:
+            while self.max_in_flight is not None and self._in_flight >= self.max_in_flight:
+                self._done.wait()
+            self._in_flight += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._pool.terminate()
+        self._pool.join()
+
+    def submit(self, im1, im2, params=None, keys=None, backend=None):
+        backend = backend or self.backend
+        if params is not None:
+            if not isinstance(backend, ElastixBackend):
+                raise ValueError('params only apply to the elastix backend')
+            backend = ElastixBackend(params, stacked=backend.stacked)
+        if self.store is None or keys is None:
+            keys = [None] * len(im1)
+        digest = backend.digest() if self.store is not None else None
+        stored = [self.store.get(key, digest) if key is not None else None for key in keys]
+
+        if backend.batched:
+            if all(x is not None for x in stored):
+                return [_StoredRegistration(x) for x in stored]
+            batch_keys = keys if keys[0] is not None else None
+            timeout = len(im1)*self.timeout
+            batch = _PendingRegistration(self, _register_batch, (backend, im1, im2, timeout),
+                                         timeout, batch_keys, digest)
+            return [_PendingSlice(batch, i) for i in range(len(im1))]
+
+        ret = []
+        for i1, i2, key, value in zip(im1, im2, keys, stored):
+            if value is not None:
+                ret.append(_StoredRegistration(value))
+            else:
+                task = _PendingRegistration(self, _register_batch,
+                                            (backend, [i1], [i2], self.timeout), self.timeout,
+                                            [key] if key is not None else None, digest)
+                ret.append(_PendingSlice(task, 0))
+        return ret
+
+
+COARSE_FACTOR = 4
+
+
+def _wait(steps):
+    """Run a step generator to completion, blocking on each group of registrations it yields."""
+    try:
+        while True:
+            for x in next(steps):
+                x.get()
+    except StopIteration as e:
+        return e.value
+
+
+def _run_scan_jobs(jobs, max_scans):
+    """Advance the step generators of up to max_scans scans as their registrations complete;
+    yields (i, result) as each scan finishes.
+    """
+    jobs = iter(jobs)
+    active, exhausted = [], False
+    while active or not exhausted:
+        while not exhausted and len(active) < max_scans:
+            try:
+                i, steps = next(jobs)
+                active.append([i, steps, []])
+            except StopIteration:
+                exhausted = True
+
+        progressed = False
+        for job in list(active):
+            if all(x.ready() for x in job[2]):
+                progressed = True
+                try:
+                    job[2] = next(job[1])
+                except StopIteration as e:
+                    active.remove(job)
+                    yield job[0], e.value
+        if not progressed:
+            time.sleep(0.01)
+
+
+def _prune_neighbors(pool, fixed, neighbors, load, keys, prune):
+    """Step generator for the prune best candidates of a cheap registration at
+    1/COARSE_FACTOR resolution.
+    """
+    if len(neighbors) <= prune:
+        return neighbors
+    small = [_downsample(x, COARSE_FACTOR) for x in fixed]
+    coarse = _get_coarse_backend(pool.backend)
+    pending = [pool.submit([_downsample(x, COARSE_FACTOR) for x in load(j)], small,
+                           keys=keys(j), backend=coarse) for j in neighbors]
+    yield sum(pending, [])
+    scores = [np.sum([x.get()[1] for x in regs]) for regs in pending]
+    return [neighbors[k] for k in np.argsort(scores, kind='mergesort')[:prune]]
+
+
+def _add_candidate(ranked, heap, candidate, n_keep):
+    """Rank a finished (j, registrations) candidate by its total residual, keeping its warped
+    stack in a max-heap of the n_keep best, which reuses the buffer of the candidate it evicts.
+    """
+    j, reg = candidate[0], [x.get() for x in candidate[1]]
+    residual = np.sum([x[1] for x in reg])
+    ranked.append((residual, j))
+    if n_keep is not None and len(heap) == n_keep:
+        if residual >= -heap[0][0]:
+            return
+        warped = heap[0][2]
+    else:
+        warped = np.zeros((len(reg),) + reg[0][0].shape, dtype='float32')
+    for k, x in enumerate(reg):
+        warped[k] = x[0]
+    item = (-residual, len(ranked), warped, j)
+    if n_keep is not None and len(heap) == n_keep:
+        heapq.heapreplace(heap, item)
+    else:
+        heapq.heappush(heap, item)
+
+
+def _register_neighbors(pool, fixed, neighbors, load, keys, prune=None, n_keep=None,
+                        max_candidates=16):
+    """Step generator registering each candidate stack to the fixed stack; returns (residual,
+    candidate, warped) sorted by residual, where warped is a float32 stack for the best n_keep
+    candidates and None for the rest. With prune, only the candidates kept by _prune_neighbors
+    are registered. At most max_candidates are registered at a time, and each is ranked and
+    dropped as soon as it finishes.
+    """
+    if prune is not None:
+        neighbors = yield from _prune_neighbors(pool, fixed, neighbors, load, keys, prune)
+
+    ranked, heap = [], []
+    todo, pending = collections.deque(neighbors), collections.deque()
+    while todo or pending:
+        while todo and len(pending) < max_candidates:
+            j = todo.popleft()
+            pending.append((j, pool.submit(list(load(j)), list(fixed), keys=keys(j))))
+        yield pending[0][1]
+        _add_candidate(ranked, heap, pending.popleft(), n_keep)
+
+    best = {x[3]: x[2] for x in heap}
+    ranked.sort(key=lambda x: x[0])
+    return [(residual, j, best.get(j)) for residual, j in ranked]
+
+
+def _aggregate_neighbors(data, cand, max_l2=None):
+    """Mean and std of the warped candidates, dropping the worst while the mean is further than
+    max_l2 from data, down to a single candidate.
+    """
+    warped = [x[2] for x in cand]
+    total, total_sq = np.zeros(data.shape), np.zeros(data.shape)
+    for x in warped:
+        total += x
+        total_sq += np.square(x, dtype='float64')
+
+    n = len(warped)
+    while True:
+        mean = (total / n).astype('float32')
+        if max_l2 is None or n == 1 or \
+           np.linalg.norm(data.astype('float32') - mean) < max_l2:
+            break
+        n -= 1
+        total -= warped[n]
+        total_sq -= np.square(warped[n], dtype='float64')
+
+    std = np.sqrt(np.maximum(total_sq/n - np.square(total/n), 0))
+    return mean, std.astype('float32')
+
+
+def register_images(im1, im2, params=None, pool=None, stacked=False, backend='elastix'):
+    if not isinstance(im1, list):
+        return register_images([im1], [im2], params, pool, stacked, backend)[0]
+    if not isinstance(im2, list):
+        im2 = [im2 for _ in range(len(im1))]
+    if pool is None:
+        with RegistrationPool(stacked=stacked, backend=backend) as pool:
+            return [x.get() for x in pool.submit(im1, im2, params)]
+    return [x.get() for x in pool.submit(im1, im2, params)]
+
+
+@cached(get_data, get_candidate_neighbors, version=0)
+def benchmark_registration_backends(mode, n_scans):
+    aps_gen = get_data(mode, 'aps')
+    neighbors = get_candidate_neighbors(mode, 8)
+
+    with open('benchmark.txt', 'w') as f:
+        for backend, stacked in [('elastix', False), ('elastix', True), ('demons', False)]:
+            impl = get_registration_backend(backend, stacked)
+            residual, t0 = 0, time.time()
+            for i in range(n_scans):
+                fixed = _normalize_scan(aps_gen[i], 'aps')
+                moving = _normalize_scan(aps_gen[neighbors[i][1]], 'aps')
+                reg = _register_batch((impl, list(moving), list(fixed), None))
+                residual += sum(float(x[1]) for x in reg) / n_scans
+            f.write('%s (stacked=%s): residual %s, %s s/pair\n' %
+                    (backend, stacked, residual, (time.time() - t0) / n_scans))
+
+
+def _normalize_scan(data, mode):
+    if mode == 'aps':
+        return np.transpose(data[2])[:, ::-1] * 1000
     else:
-        return _register_images((im1, im2, params))
+        return np.transpose(data[2])[::4, ::-1]
+
+
+def _get_scan_names(gen):
+    return [file.replace('\\', '/').split('/')[-1].split('.')[0] for file in gen.files]
+
+
+def _register_mirror(pool, name, data, modality):
+    rot = np.concatenate([data[0:1, :, ::-1], data[-1::-1, :, ::-1]])
+    keys = [(name + '_mirror', name, k, modality) for k in range(16)]
+    pending = pool.submit(list(rot), list(data), keys=keys, backend=get_registration_backend())
+    yield pending
+    return np.stack([x.get()[0] for x in pending])
 
 
-@cached(get_aps_data_hdf5, get_candidate_neighbors, subdir='ssd', cloud_cache=True, version=0)
+def _get_split_range(n, n_split, split_id):
+    m = int(np.ceil(n/n_split))
+    return split_id*m, min(n, (split_id+1)*m)
+
+
+@cached(get_data, subdir='ssd', version=1)
+def get_mirror_registrations():
+    """Directory of the mirror registration of every scan, filled in as scans are augmented."""
+    return os.getcwd()
+
+
+def _get_mirror_registration(pool, mirror_dir, name, data, modality):
+    """Step generator for the mirror registration of a scan, registered on first use and then
+    shared by every split and worker that processes the scan.
+    """
+    path = '%s/%s/%s.npy' % (mirror_dir, modality, name)
+    if os.path.exists(path):
+        return np.load(path)
+    reg = yield from _register_mirror(pool, name, data, modality)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, reg)
+    os.rename(tmp, path)
+    return reg
+
+
+@cached(get_aps_data_hdf5, get_candidate_neighbors, get_mirror_registrations, subdir='ssd',
+        cloud_cache=True, version=0)
 def get_augmented_aps_segmentation_data(mode, n_split, split_id):
     if not os.path.exists('done'):
         names, labels, dset_in = dataio.get_data_and_threat_heatmaps(mode)
-        n = len(dset_in)
-        m = int(np.ceil(n/n_split))
-        i1, i2 = split_id*m, min(n, (split_id+1)*m)
+        i1, i2 = _get_split_range(len(dset_in), n_split, split_id)
         n_neighbor = 8
 
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (i2-i1, 16, 660, 512, 7))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (i2-i1, 16, 660, 512, 7), access='channel')
         neighbors = get_candidate_neighbors(mode, n_neighbor)
+        mirror_dir = get_mirror_registrations()
 
         scale = 1000
-        for i in tqdm.trange(i1, i2):
-            data = np.rollaxis(dset_in[i], 2, 0) * scale
-            dset[i-i1, ..., 0] = data[..., 0]
-            dset[i-i1, ..., 4:] = data[..., 1:]
-
-            im1, im2 = [], []
-            rot = np.concatenate([data[0:1, :, ::-1, 0], data[-1::-1, :, ::-1, 0]])
-            for j in range(16):
-                im1.append(rot[j])
-                im2.append(data[j, ..., 0])
-            reg = register_images(im1, im2)
-            for j in range(16):
-                dset[i-i1, j, ..., 1] = reg[j][0]
-
-            cand = []
-            for j in tqdm.tqdm(neighbors[i]):
-                im1, im2 = [], []
-                for k in range(16):
-                    im1.append(dset_in[j, ..., k, 0] * scale)
-                    im2.append(data[k, ..., 0])
-                reg = register_images(im1, im2)
-                cand.append((sum(x[1] for x in reg), (np.stack([x[0] for x in reg]))))
-            cand.sort()
-            cand = np.stack([x[1] for x in cand[:n_neighbor]])
-            dset[i-i1, ..., 2] = np.mean(cand, axis=0)
-            dset[i-i1, ..., 3] = np.std(cand, axis=0)
+        out = np.zeros(dset.shape[1:], dtype='float32')
+        with RegistrationPool() as pool:
+            for i in tqdm.trange(i1, i2):
+                data = np.rollaxis(dset_in[i], 2, 0) * scale
+                out[..., 0] = data[..., 0]
+                out[..., 4:] = data[..., 1:]
+                out[..., 1] = _wait(_get_mirror_registration(pool, mirror_dir, names[i],
+                                                             data[..., 0], 'aps'))
+
+                cand = _wait(_register_neighbors(
+                    pool, data[..., 0], neighbors[i],
+                    lambda j: np.rollaxis(dset_in[j, ..., 0], 2, 0) * scale,
+                    lambda j: [(names[j], names[i], k, 'aps') for k in range(16)],
+                    n_keep=n_neighbor))
+                out[..., 2], out[..., 3] = _aggregate_neighbors(data[..., 0], cand[:n_neighbor])
+                dset[i-i1] = out
 
         with open('pkl', 'wb') as f:
             pickle.dump((names, labels), f)
@@ -303,106 +1059,197 @@ def get_augmented_aps_segmentation_data(mode, n_split, split_id):
     else:
         with open('pkl', 'rb') as f:
             names, labels = pickle.load(f)
-        f = h5py.File('data.hdf5', 'r')
+        f = open_hdf5('data.hdf5')
         dset = f['dset']
     return names, labels, dset
 
 
-@cached(get_data, get_candidate_neighbors, subdir='ssd', cloud_cache=True, version=1)
-def get_augmented_segmentation_data_split(mode, n_split, split_id):
-    if not os.path.exists('done'):
-        aps_gen, a3daps_gen = get_data(mode, 'aps'), get_data(mode, 'a3daps')
-        n = len(aps_gen)
-        m = int(np.ceil(n/n_split))
-        i1, i2 = split_id*m, min(n, (split_id+1)*m)
-        n_neighbor = 8
+# shared directory of the augmentation work queue; when set, the segmentation models read the
+# scans assembled from run_augmented_segmentation_worker instead of the static splits
+AUGMENTATION_QUEUE_DIR = None
 
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (i2-i1, 16, 660, 512, 8))
-        neighbors = get_candidate_neighbors(mode, n_neighbor)
 
-        def normalize(data, mode):
-            if mode == 'aps':
-                return np.transpose(data[2])[:, ::-1] * 1000
-            else:
-                return np.transpose(data[2])[::4, ::-1]
-
-        gen = zip(aps_gen[i1:i2], a3daps_gen[i1:i2])
-        max_l2 = [88, 66]
-        for i, (aps_data, a3daps_data) in tqdm.tqdm(enumerate(gen), total=i2-i1):
-            di = 0
-            for data, mode in [(aps_data, 'aps'), (a3daps_data, 'a3daps')]:
-                data = normalize(data, mode)
-                dset[i, ..., di] = data
-
-                im1, im2 = [], []
-                rot = np.concatenate([data[0:1, :, ::-1], data[-1::-1, :, ::-1]])
-                for j in range(16):
-                    im1.append(rot[j])
-                    im2.append(data[j])
-                reg = register_images(im1, im2)
-                for j in range(16):
-                    dset[i, j, ..., di+1] = reg[j][0]
-
-                cand = []
-                for j in tqdm.tqdm(neighbors[i1+i]):
-                    neighbor = aps_gen[j] if mode == 'aps' else a3daps_gen[j]
-                    neighbor = normalize(neighbor, mode)
-                    im1, im2 = [], []
-                    for k in range(16):
-                        im1.append(neighbor[k])
-                        im2.append(data[k])
-                    reg = register_images(im1, im2)
-                    cand.append((sum(x[1] for x in reg), (np.stack([x[0] for x in reg]))))
-                cand.sort(key=lambda x: x[0])
-
-                n_include = n_neighbor
-                while True:
-                    nn = np.stack([x[1] for x in cand[:n_include]])
-                    dset[i, ..., di+2] = np.mean(nn, axis=0)
-                    dset[i, ..., di+3] = np.std(nn, axis=0)
-
-                    if np.linalg.norm(dset[i, ..., di] - dset[i, ..., di+2]) < max_l2[di//4]:
-                        break
-                    n_include -= 1
-
-                di += 4
+def _augment_scan(pool, i, aps_gen, a3daps_gen, names, neighbors, mirror_dir, prune=None):
+    """Step generator for the augmented channels of scan i, returned as a float32 array."""
+    n_neighbor = 8
+    max_l2 = [88, 66]
+    name = names[i]
+    out = np.zeros((16, 660, 512, 8), dtype='float32')
+    di = 0
+    for mode, gen_in in [('aps', aps_gen), ('a3daps', a3daps_gen)]:
+        data = _normalize_scan(gen_in[i], mode)
+        out[..., di] = data
+        out[..., di+1] = yield from _get_mirror_registration(pool, mirror_dir, name, data, mode)
+
+        cand = yield from _register_neighbors(
+            pool, data, neighbors[i],
+            lambda j: _normalize_scan(gen_in[j], mode),
+            lambda j: [(names[j], name, k, mode) for k in range(16)], prune,
+            n_keep=n_neighbor)
+
+        out[..., di+2], out[..., di+3] = \
+            _aggregate_neighbors(data, cand[:n_neighbor], max_l2[di//4])
+
+        di += 4
+    return out
+
+
+class _ScanList(object):
+    """The scans of several modes indexed as one list, in order."""
+
+    def __init__(self, gens):
+        self._gens = gens
+        self._offsets = np.cumsum([0] + [len(gen) for gen in gens])
+        self.files = [file for gen in gens for file in gen.files]
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        k = np.searchsorted(self._offsets, i, side='right') - 1
+        return self._gens[k][i - self._offsets[k]]
+
+
+def _get_neighbors(mode, neighbors):
+    """Candidate neighbors of every scan of mode, and the aps and a3daps scans they index."""
+    assert neighbors in ('exact', 'approximate', 'reference')
+    if neighbors == 'exact':
+        modes, cand = [mode], get_candidate_neighbors(mode, 8)
+    elif neighbors == 'approximate':
+        modes, cand = [mode], get_approximate_candidate_neighbors(mode, 8)
+    else:
+        modes, cand = get_reference_candidate_neighbors(mode, 'all', 32)
+    gens = [_ScanList([get_data(m, modality) for m in modes]) for modality in ('aps', 'a3daps')]
+    return cand, gens[0], gens[1]
+
+
+@cached(get_data, get_candidate_neighbors, get_approximate_candidate_neighbors,
+        get_reference_candidate_neighbors, get_mirror_registrations, subdir='ssd',
+        cloud_cache=True, version=1)
+def get_augmented_segmentation_data_split(mode, n_split, split_id, neighbors='exact',
+                                          stacked=False, backend='elastix', prune=None):
+    if not os.path.exists('done'):
+        i1, i2 = _get_split_range(len(get_data(mode, 'aps')), n_split, split_id)
+
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (i2-i1, 16, 660, 512, 8), access='channel')
+        neighbors, aps_gen, a3daps_gen = _get_neighbors(mode, neighbors)
+        names = _get_scan_names(aps_gen)
+        mirror_dir = get_mirror_registrations()
+
+        max_scans = 4
+        max_in_flight = 64 * multiprocessing.cpu_count()
+        with RegistrationPool(stacked=stacked, backend=backend,
+                              max_in_flight=max_in_flight) as pool:
+            jobs = ((i, _augment_scan(pool, i, aps_gen, a3daps_gen, names, neighbors, mirror_dir,
+                                      prune))
+                    for i in range(i1, i2))
+            for i, out in tqdm.tqdm(_run_scan_jobs(jobs, max_scans), total=i2-i1):
+                dset[i-i1] = out
 
         f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
+    f = open_hdf5('data.hdf5')
     dset = f['dset']
     return dset
 
 
-@cached(get_augmented_segmentation_data_split, subdir='ssd', cloud_cache=True, version=0)
-def get_augmented_segmentation_data(mode, n_split):
+def run_augmented_segmentation_worker(mode, queue_dir, neighbors='exact', stacked=False,
+                                      backend='elastix', prune=None):
+    neighbors, aps_gen, a3daps_gen = _get_neighbors(mode, neighbors)
+    names = _get_scan_names(aps_gen)
+    n = len(get_data(mode, 'aps'))
+    name_idx = {name: i for i, name in enumerate(names[:n])}
+    mirror_dir = get_mirror_registrations()
+
+    path = '%s/%s' % (queue_dir, mode)
+    queue = WorkQueue(path, names[:n])
+    if not os.path.exists('%s/results' % path):
+        os.makedirs('%s/results' % path, exist_ok=True)
+
+    # closing the queue iterator releases the leased scan and stops its heartbeat right away if
+    # augmenting it fails, instead of whenever the generator is collected
+    items = iter(queue)
+    with RegistrationPool(stacked=stacked, backend=backend) as pool:
+        try:
+            for name in items:
+                out = _wait(_augment_scan(pool, name_idx[name], aps_gen, a3daps_gen, names,
+                                          neighbors, mirror_dir, prune))
+                tmp = '%s/results/%s.%s.tmp' % (path, name, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.save(f, out)
+                os.rename(tmp, '%s/results/%s.npy' % (path, name))
+        finally:
+            items.close()
+
+
+@cached(get_data, get_candidate_neighbors, get_approximate_candidate_neighbors,
+        get_reference_candidate_neighbors, get_mirror_registrations, subdir='ssd', version=0)
+def join_augmented_segmentation_data_queue(mode, queue_dir):
     if not os.path.exists('done'):
-        dsets = []
-        for split_id in tqdm.trange(n_split):
-            dsets.append(get_augmented_segmentation_data_split(mode, n_split, split_id))
+        names = _get_scan_names(get_data(mode, 'aps'))
+        path = '%s/%s' % (queue_dir, mode)
+        queue = WorkQueue(path, names)
+        while queue.remaining():
+            print('waiting for %s scans' % len(queue.remaining()))
+            time.sleep(queue.poll_interval)
+
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(names), 16, 660, 512, 8), access='channel')
+        for i, name in enumerate(tqdm.tqdm(names)):
+            dset[i] = np.load('%s/results/%s.npy' % (path, name))
 
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (sum(len(x) for x in dsets),) + dsets[0].shape[1:])
+        f.close()
+        open('done', 'w').close()
+
+    f = open_hdf5('data.hdf5')
+    dset = f['dset']
+    return dset
 
-        moments = np.zeros((8, 2))
-        i = 0
-        for dset_in in dsets:
-            for data in tqdm.tqdm(dset_in):
-                dset[i] = data
-                moments[:, 0] += np.mean(data, axis=(0, 1, 2)) / len(dset)
-                moments[:, 1] += np.mean(data**2, axis=(0, 1, 2)) / len(dset)
-                i += 1
 
+@cached(get_data, get_candidate_neighbors, version=0)
+def get_pruning_agreement(mode, n_scans, prune):
+    aps_gen = get_data(mode, 'aps')
+    names = _get_scan_names(aps_gen)
+    neighbors = get_candidate_neighbors(mode, 8)
+    load = lambda j: _normalize_scan(aps_gen[j], 'aps')
+
+    changed, overlap = 0, 0
+    with RegistrationPool() as pool:
+        for i in tqdm.trange(n_scans):
+            keys = lambda j: [(names[j], names[i], k, 'aps') for k in range(16)]
+            cand = _wait(_register_neighbors(pool, load(i), neighbors[i], load, keys, n_keep=8))
+            kept = set(_wait(_prune_neighbors(pool, load(i), neighbors[i], load, keys, prune)))
+            exact = set(x[1] for x in cand[:8])
+            pruned = set([x[1] for x in cand if x[1] in kept][:8])
+            changed += exact != pruned
+            overlap += len(exact & pruned) / len(exact) / n_scans
+
+    with open('agreement.txt', 'w') as f:
+        f.write('top-8 set changed: %s/%s\n' % (changed, n_scans))
+        f.write('mean top-8 overlap: %s\n' % overlap)
+    return changed / n_scans, overlap
+
+
+@cached(get_augmented_segmentation_data_split, join_augmented_segmentation_data_queue, subdir='ssd',
+        cloud_cache=True, version=1)
+def get_augmented_segmentation_data(mode, n_split, queue_dir=None):
+    if queue_dir:
+        dset = join_augmented_segmentation_data_queue(mode, queue_dir)
+    else:
+        dset = ConcatenatedView([get_augmented_segmentation_data_split(mode, n_split, split_id)
+                                 for split_id in range(n_split)])
+    if not os.path.exists('done'):
+        moments = np.zeros((8, 2))
+        for data in tqdm.tqdm(dset):
+            moments[:, 0] += np.mean(data, axis=(0, 1, 2)) / len(dset)
+            moments[:, 1] += np.mean(data**2, axis=(0, 1, 2)) / len(dset)
         moments[:, 1] = np.sqrt(moments[:, 1] - moments[:, 0]**2)
 
         np.save('moments.npy', moments)
-        f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
-    dset = f['dset']
     moments = np.load('moments.npy')
     return dset, moments
 
@@ -410,24 +1257,7 @@ def get_augmented_segmentation_data(mode, n_split):
 @cached(get_aps_data_hdf5, get_augmented_aps_segmentation_data, subdir='ssd', cloud_cache=True,
         version=0)
 def join_augmented_aps_segmentation_data(mode, n_split):
-    if not os.path.exists('done'):
-        names, labels, dset_in = dataio.get_aps_data_hdf5(mode)
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(dset_in), 16, 660, 512, 7))
-
-        i = 0
-        for split_id in tqdm.trange(n_split):
-            _, _, split_dset = get_augmented_aps_segmentation_data(mode, n_split, split_id)
-            for j, data in enumerate(tqdm.tqdm(split_dset)):
-                dset[i] = data
-                i += 1
-
-        with open('pkl', 'wb') as f:
-            pickle.dump((names, labels), f)
-        open('done', 'w').close()
-    else:
-        with open('pkl', 'rb') as f:
-            names, labels = pickle.load(f)
-        f = h5py.File('data.hdf5', 'r')
-        dset = f['dset']
+    names, labels, _ = dataio.get_aps_data_hdf5(mode)
+    dset = ConcatenatedView([get_augmented_aps_segmentation_data(mode, n_split, split_id)[2]
+                             for split_id in range(n_split)])
     return names, labels, dset
@@ -0,0 +1,170 @@
+from common.caching import read_input_dir, cached
+
+import numpy as np
+import ctypes
+import math
+import os
+import subprocess
+import time
+
+
+# port of input/scripts/spatial_pooling_v0.cpp; hulls are (A, N, M, K) float32 arrays of a depth
+# channel (1 where there is no body) followed by K-1 zone channels, for A angles
+A, N, M, K, L = 16, 330, 256, 19, 7
+_lib = None
+
+
+def _rotate_point(x, y, angle):
+    y = y*M - M//2
+    x = x - M//2
+    rx, ry = np.cos(angle)*x - np.sin(angle)*y, np.sin(angle)*x + np.cos(angle)*y
+    return np.clip(rx + M//2, 0, M-1), (ry + M//2) / M
+
+
+def rotate_hulls(hulls, base):
+    """Rasterize the hull of every angle as seen from angle base, keeping the nearest surface."""
+    depth = hulls[..., 0].astype('float64')
+    d1, d2 = depth[..., :-1], depth[..., 1:]
+    a, i, j = np.nonzero((d1 != 1) & (d2 != 1) & (np.abs(d1 - d2) <= 0.1))
+    angle = 2*math.pi/A*(a-base)
+    x1, y1 = _rotate_point(j, d1[a, i, j], angle)
+    x2, y2 = _rotate_point(j+1, d2[a, i, j], angle)
+
+    # one fragment for each integer column jj with int(x1) <= jj <= x2
+    start = x1.astype('int64')
+    count = np.maximum(np.floor(x2).astype('int64') - start + 1, 0)
+    seg = np.repeat(np.arange(len(count)), count)
+    jj = start[seg] + np.arange(len(seg)) - np.repeat(np.cumsum(count) - count, count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = y1[seg] + (y2-y1)[seg]*(jj-x1[seg])/(x2-x1)[seg]
+    key = (a[seg]*N + i[seg])*M + jj
+
+    # z-buffer; the sequential loop compares against depths stored as float32, so the winner is
+    # found by replaying, in segment order, only the fragments within an ulp of the nearest one
+    best = np.ones(A*N*M)
+    np.fmin.at(best, key, d)
+    near = np.nextafter(best.astype('float32'), np.float32(np.inf))
+    near = np.nonzero((d < near[key]) & (d < 1))[0]
+    near = near[np.lexsort((seg[near], key[near]))]
+    first = np.r_[True, key[near][1:] != key[near][:-1]]
+    rank = np.arange(len(near)) - np.maximum.accumulate(np.where(first, np.arange(len(near)), 0))
+
+    stored = np.ones(A*N*M, dtype='float32')
+    src = np.full(A*N*M, M, dtype='int64')
+    for r in range(rank.max() + 1 if len(near) else 0):
+        cur = near[rank == r]
+        cur = cur[d[cur] < stored[key[cur]]]
+        stored[key[cur]] = d[cur]
+        src[key[cur]] = j[seg[cur]]
+
+    out = np.zeros((A*N*M, K), dtype='float32')
+    out[:, 0] = stored
+    idx = np.nonzero(src < M)[0]
+    out[idx, 1:] = hulls[idx // (N*M), idx // M % N, src[idx], 1:]
+    return out.reshape((A, N, M, K))
+
+
+def spatial_pool_hulls(hulls, per_channel=True):
+    """Median of the L nearest rotated hulls at each body pixel, for every channel separately,
+    or of every channel taken from the hull at the median depth as in spatial_pooling.cpp.
+    """
+    out = np.zeros((A, N, M, K), dtype='float32')
+    for base in range(A):
+        rot = rotate_hulls(hulls, base)
+        mask = hulls[base, ..., 0] != 1
+        cand = rot[:, mask]
+        n = cand.shape[1]
+
+        pools = np.ones((n, L, K), dtype='float32')
+        for aa in range(A):
+            maxd = np.argmax(pools[..., 0], axis=1)
+            replace = np.nonzero(cand[aa, :, 0] < pools[np.arange(n), maxd, 0])[0]
+            pools[replace, maxd[replace]] = cand[aa, replace]
+
+        num = np.sum(pools[..., 0] != 1, axis=1)
+        if per_channel:
+            pooled = np.sort(pools, axis=1)[np.arange(n), num//2]
+        else:
+            order = np.argsort(pools[..., 0], axis=1, kind='stable')
+            pooled = pools[np.arange(n), order[np.arange(n), num//2]]
+        pooled[num == 0] = 0
+        out[base][mask] = pooled
+    return out
+
+
+def _get_lib():
+    global _lib
+    if _lib is None:
+        with read_input_dir('scripts'):
+            _lib = ctypes.CDLL(os.getcwd() + '/libspatial_pooling.so')
+        _lib.spatial_pool.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        _lib.spatial_pool.restype = None
+    return _lib
+
+
+def spatial_pool_batch(hulls, out, per_channel=True):
+    """Pool a batch of hulls into out in-process with the compiled spatial_pooling.cpp, which
+    matches spatial_pool_hulls bit for bit and runs in parallel over scans and base angles.
+    """
+    assert hulls.shape[1:] == (A, N, M, K) and out.shape == hulls.shape
+    assert hulls.dtype == out.dtype == np.float32
+    assert hulls.flags.c_contiguous and out.flags.c_contiguous
+    _get_lib().spatial_pool(hulls.ctypes.data, out.ctypes.data, len(hulls), per_channel)
+
+
+def get_synthetic_hulls(seed):
+    """Smooth random body surfaces with softmax zone channels, for benchmarking."""
+    rng = np.random.RandomState(seed)
+    j, i = np.arange(M)[np.newaxis], np.arange(N)[:, np.newaxis]
+    hulls = np.zeros((A, N, M, K), dtype='float32')
+    for a in range(A):
+        depth = 0.5 + 0.2*np.cos((j-M/2)/60 + a) + 0.05*np.sin(i/30) + 0.01*rng.rand(N, M)
+        body = np.abs(j-M/2) < 60 + 20*np.sin(i/50 + a)
+        hulls[a, ..., 0] = np.where(body, np.round(depth*512)/512, 1)
+    zones = rng.rand(A, N, M, K-1)
+    hulls[..., 1:] = zones / np.sum(zones, axis=-1, keepdims=True)
+    return hulls
+
+
+@cached(version=1)
+def benchmark_spatial_pooling(n_scans):
+    """Time the executables, which run one scan per process through files, against the in-process
+    kernel and the NumPy port, and count the scans where their outputs differ.
+    """
+    with read_input_dir('scripts'):
+        exes = {name: os.getcwd() + '/' + name
+                for name in ('spatial_pooling_v0', 'spatial_pooling')}
+
+    times = {name: 0 for name in ('spatial_pooling_v0', 'spatial_pooling', 'in_process',
+                                  'in_process_per_channel', 'numpy')}
+    mismatches = 0
+    for seed in range(n_scans):
+        hulls = get_synthetic_hulls(seed)
+        hulls.tofile('hulls.in')
+        for name, exe in exes.items():
+            t0 = time.time()
+            subprocess.check_call([exe, 'hulls.in', '%s.out' % name])
+            times[name] += (time.time() - t0) / n_scans
+        v0 = np.fromfile('spatial_pooling_v0.out', dtype='float32').reshape(hulls.shape)
+        v1 = np.fromfile('spatial_pooling.out', dtype='float32').reshape(hulls.shape)
+        for file in ('hulls.in', 'spatial_pooling_v0.out', 'spatial_pooling.out'):
+            os.remove(file)
+
+        out = {}
+        for per_channel, name in ((False, 'in_process'), (True, 'in_process_per_channel')):
+            out[per_channel] = np.zeros((1,) + hulls.shape, dtype='float32')
+            t0 = time.time()
+            spatial_pool_batch(hulls[np.newaxis], out[per_channel], per_channel)
+            times[name] += (time.time() - t0) / n_scans
+        t0 = time.time()
+        ref = spatial_pool_hulls(hulls, per_channel=False)
+        times['numpy'] += (time.time() - t0) / n_scans
+
+        same = [np.array_equal(v0, out[True][0]), np.array_equal(v1, out[False][0]),
+                np.array_equal(v1, ref), np.array_equal(v0[..., 0], v1[..., 0])]
+        mismatches += not all(same)
+
+    with open('benchmark.txt', 'w') as f:
+        for name, t in times.items():
+            f.write('%s: %s s/scan\n' % (name, t))
+        f.write('scans where the implementations disagree: %s\n' % mismatches)
@@ -1,5 +1,6 @@
 from common.caching import read_input_dir, cached, read_log_dir
-from common.dataio import get_aps_data_hdf5, get_passenger_clusters, get_data
+from common.dataio import get_aps_data_hdf5, get_passenger_clusters, get_data, create_dataset, \
+                          open_hdf5
 
 from . import dataio
 
@@ -11,7 +12,6 @@ import skimage.color
 import glob
 import os
 import tqdm
-import h5py
 import pickle
 import imageio
 import math
@@ -97,8 +97,9 @@ def render_synthetic_zone_data(mode):
             }, f)
         subprocess.check_call(['blender', '--python', script_path, '--background'])
 
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(mesh_paths), angles, 330, 256, 2))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(mesh_paths), angles, 330, 256, 2), access='angle',
+                              compress=True)
 
         for i, file in enumerate(tqdm.tqdm(glob.glob('*_depth.png'))):
             zones_file = file.replace('depth', 'zones')
@@ -110,6 +111,6 @@ def render_synthetic_zone_data(mode):
 
         open('done', 'w').close()
     else:
-        f = h5py.File('data.hdf5', 'r')
+        f = open_hdf5('data.hdf5')
         dset = f['dset']
     return dset
\ No newline at end of file
@@ -1,7 +1,7 @@
 from common.caching import cached, read_log_dir
 from common.math import sigmoid, log_loss
 from common.dataio import get_train_idx, get_valid_idx, get_train_labels, write_answer_csv, \
-                          get_cv_splits
+                          get_cv_splits, RoundTripView, CompactZonesView
 
 from . import tf_models
 from . import body_zone_segmentation
@@ -19,15 +19,36 @@ import h5py
 import pickle
 
 
+def _get_body_zones(mode, compact_zones):
+    if compact_zones:
+        return body_zone_segmentation.get_compact_body_zones(mode)
+    return body_zone_segmentation.get_body_zones(mode)
+
+
 @cached(threat_segmentation_models.get_all_multitask_cnn_predictions,
-        body_zone_segmentation.get_body_zones, version=12, cloud_cache=True)
+        body_zone_segmentation.get_body_zones, body_zone_segmentation.get_compact_body_zones,
+        version=12, cloud_cache=True)
 def train_simple_segmentation_model(mode, cvid, duration, learning_rate=1e-3, num_filters=0,
                                     num_layers=0, blur_size=0, per_zone=None, use_hourglass=False,
                                     use_rotation=False, log_scale=False, num_conv=1,
-                                    num_conv_filters=0, init_conf=1, zones_bias=False):
+                                    num_conv_filters=0, init_conf=1, zones_bias=False,
+                                    compact_zones=False):
     tf.reset_default_graph()
 
-    zones_in = tf.placeholder(tf.float32, [16, 330, 256, 18])
+    if compact_zones:
+        # zone maps are read as top zone indices and weights, and densified on the device
+        zones_index_in = tf.placeholder(tf.uint8, [16, 330, 256, None])
+        zones_weight_in = tf.placeholder(tf.float32, [16, 330, 256, None])
+        zones_in = tf.reduce_sum(tf.one_hot(tf.cast(zones_index_in, tf.int32), 18) *
+                                 zones_weight_in[..., tf.newaxis], axis=-2)
+    else:
+        zones_in = tf.placeholder(tf.float32, [16, 330, 256, 18])
+
+    def zones_feed(zones_all, i):
+        if isinstance(zones_all, CompactZonesView):
+            index, weight = zones_all.read_compact(i)
+            return {zones_index_in: index, zones_weight_in: weight}
+        return {zones_in: zones_all[i]}
     hmaps_in = tf.placeholder(tf.float32, [16, 330, 256, 6])
     labels_in = tf.placeholder(tf.float32, [17])
     confidence = tf.get_variable('confidence', [], initializer=tf.constant_initializer(init_conf))
@@ -208,17 +229,16 @@ def train_simple_segmentation_model(mode, cvid, duration, learning_rate=1e-3, nu
             saver.restore(sess, model_path)
             for i in tqdm.tqdm(idx):
                 ret = np.zeros(17)
+                feed_dict = zones_feed(zones_all, i)
+                feed_dict[hmaps_in] = hmaps_all[i]
                 for _ in range(n_sample):
-                    ret += sess.run(preds, feed_dict={
-                        zones_in: zones_all[i],
-                        hmaps_in: hmaps_all[i]
-                    })
+                    ret += sess.run(preds, feed_dict=feed_dict)
                 yield ret / n_sample
 
     if os.path.exists('done'):
         return predict
 
-    _, _, zones_all = body_zone_segmentation.get_body_zones(mode)
+    _, _, zones_all = _get_body_zones(mode, compact_zones)
     hmaps_all = threat_segmentation_models.get_all_multitask_cnn_predictions(mode)
     labels_all = [y for x, y in sorted(get_train_labels().items())]
     train_idx, valid_idx = get_train_idx(mode, cvid), get_valid_idx(mode, cvid)
@@ -228,11 +248,10 @@ def train_simple_segmentation_model(mode, cvid, duration, learning_rate=1e-3, nu
 
     def data_gen(zones_all, hmaps_all, labels_all, idx):
         for i in tqdm.tqdm(idx):
-            yield {
-                zones_in: zones_all[i],
-                hmaps_in: hmaps_all[i],
-                labels_in: np.array(labels_all[i])
-            }
+            feed_dict = zones_feed(zones_all, i)
+            feed_dict[hmaps_in] = hmaps_all[i]
+            feed_dict[labels_in] = np.array(labels_all[i])
+            yield feed_dict
 
     def eval_model(sess):
         losses = []
@@ -272,7 +291,7 @@ def train_simple_segmentation_model(mode, cvid, duration, learning_rate=1e-3, nu
 @cached(train_simple_segmentation_model, version=0)
 def get_simple_segmentation_model_predictions(mode, *args, **kwargs):
     if not os.path.exists('done'):
-        names, _, zones_all = body_zone_segmentation.get_body_zones(mode)
+        names, _, zones_all = _get_body_zones(mode, kwargs.get('compact_zones', False))
         hmaps_all = threat_segmentation_models.get_all_multitask_cnn_predictions(mode)
         predict = train_simple_segmentation_model(*args, **kwargs)
 
@@ -291,6 +310,33 @@ def get_simple_segmentation_model_predictions(mode, *args, **kwargs):
     return names, preds
 
 
+@cached(train_simple_segmentation_model, version=0)
+def get_precision_logloss_delta(zones_precision, hmaps_precision):
+    names, _, zones_all = body_zone_segmentation.get_body_zones('all')
+    hmaps_all = threat_segmentation_models.get_all_multitask_cnn_predictions('all')
+    labels = get_train_labels()
+
+    def out_of_fold_loss(zones, hmaps):
+        total_loss = 0
+        for cvid in range(5):
+            predict = train_simple_segmentation_model('all', cvid, 2, num_filters=16, num_layers=16,
+                                                      per_zone='bias')
+            idx = get_valid_idx('all', cvid)
+            for i, pred in zip(idx, predict(zones, hmaps, idx, n_sample=4)):
+                total_loss += np.mean(log_loss(pred, np.array(labels[names[i]]))) / len(names)
+        return total_loss
+
+    base_loss = out_of_fold_loss(zones_all, hmaps_all)
+    loss = out_of_fold_loss(RoundTripView(zones_all, zones_precision),
+                            RoundTripView(hmaps_all, hmaps_precision))
+
+    with open('loss.txt', 'w') as f:
+        f.write('float32: %s\n' % base_loss)
+        f.write('zones %s, hmaps %s: %s\n' % (zones_precision, hmaps_precision, loss))
+        f.write('delta: %s\n' % (loss - base_loss))
+    return loss - base_loss
+
+
 @cached(get_simple_segmentation_model_predictions, version=0)
 def get_ensembled_model_predictions(mode):
     if not os.path.exists('done'):
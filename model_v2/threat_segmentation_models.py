@@ -1,6 +1,7 @@
 from common.caching import cached, read_log_dir
 from common.math import sigmoid, log_loss
-from common.dataio import get_train_idx, get_valid_idx
+from common.dataio import get_train_idx, get_valid_idx, ChannelView, create_dataset, open_hdf5, \
+                          open_dataset, PRECISION_POLICY
 
 from . import tf_models
 from . import dataio
@@ -14,7 +15,6 @@ import time
 import tqdm
 import math
 import random
-import h5py
 import keras
 import skimage.transform
 
@@ -80,7 +80,7 @@ def train_multitask_cnn(mode, cvid, duration, weights, sanity_check=False, norma
         with tf.Session() as sess:
             saver.restore(sess, model_path)
             for data in tqdm.tqdm(dset):
-                pred = np.zeros((angles, height, width, 6))
+                pred = np.zeros((angles, height, width, 6), dtype='float32')
                 data = np.concatenate([data[:, ::downsize, ::downsize],
                                        np.zeros((angles, height, width, 6))], axis=-1)
                 for _ in range(n_sample):
@@ -92,7 +92,8 @@ def train_multitask_cnn(mode, cvid, duration, weights, sanity_check=False, norma
     if os.path.exists('done'):
         return predict
 
-    dset_all, _ = passenger_clustering.get_augmented_segmentation_data(mode, 10)
+    dset_all, _ = passenger_clustering.get_augmented_segmentation_data(
+        mode, 10, passenger_clustering.AUGMENTATION_QUEUE_DIR)
     labels_all, means_all = dataio.get_augmented_threat_heatmaps(mode)
     train_idx, valid_idx = get_train_idx(mode, cvid), get_valid_idx(mode, cvid)
 
@@ -147,9 +148,11 @@ def train_multitask_cnn(mode, cvid, duration, weights, sanity_check=False, norma
 @cached(train_multitask_cnn, subdir='ssd', cloud_cache=True, version=0)
 def get_multitask_cnn_predictions(mode, n_split, lid):
     if not os.path.exists('done'):
-        f = h5py.File('data.hdf5', 'w')
-        dset_in, _ = passenger_clustering.get_augmented_segmentation_data(mode, n_split)
-        dset = f.create_dataset('dset', (len(dset_in), 16, 330, 256))
+        f = open_hdf5('data.hdf5', 'w')
+        dset_in, _ = passenger_clustering.get_augmented_segmentation_data(
+            mode, n_split, passenger_clustering.AUGMENTATION_QUEUE_DIR)
+        dset = create_dataset(f, 'dset', (len(dset_in), 16, 330, 256), compress=True,
+                              precision=PRECISION_POLICY['multitask_predictions'])
 
         weights = tuple(int(i == lid) for i in range(6))
         predict = train_multitask_cnn('all', -1, 12, weights, normalize_data=False,
@@ -160,28 +163,14 @@ def get_multitask_cnn_predictions(mode, n_split, lid):
         f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
-    dset = f['dset']
+    f = open_hdf5('data.hdf5')
+    dset = open_dataset(f, 'dset')
     return dset
 
 
 @cached(get_multitask_cnn_predictions, subdir='ssd', version=0)
 def get_all_multitask_cnn_predictions(mode):
-    if not os.path.exists('done'):
-        f = h5py.File('data.hdf5', 'w')
-        dsets = [get_multitask_cnn_predictions(mode, 10, i) for i in range(6)]
-        dset = f.create_dataset('dset', (len(dsets[0]), 16, 330, 256, 6))
-
-        for dset_idx in tqdm.trange(6):
-            for i in tqdm.trange(len(dset)):
-                dset[i, ..., dset_idx] = dsets[dset_idx][i]
-
-        f.close()
-        open('done', 'w').close()
-
-    f = h5py.File('data.hdf5', 'r')
-    dset = f['dset']
-    return dset
+    return ChannelView([get_multitask_cnn_predictions(mode, 10, i) for i in range(6)], stack=True)
 
 
 @cached(passenger_clustering.join_augmented_aps_segmentation_data, cloud_cache=True, version=4)
@@ -297,7 +286,7 @@ def train_augmented_hourglass_cnn(mode, duration, learning_rate=1e-3, random_sca
         with tf.Session() as sess:
             saver.restore(sess, model_path)
             for data in tqdm.tqdm(dset):
-                pred = np.zeros((angles, height, width))
+                pred = np.zeros((angles, height, width), dtype='float32')
                 mean_loss = 0
                 for _ in range(n_sample):
                     cur_loss, cur_pred = sess.run([loss, preds], feed_dict={
@@ -367,8 +356,9 @@ def train_augmented_hourglass_cnn(mode, duration, learning_rate=1e-3, random_sca
 def get_augmented_hourglass_predictions(mode):
     if not os.path.exists('done'):
         _, _, dset_in = passenger_clustering.join_augmented_aps_segmentation_data(mode, 6)
-        f = h5py.File('data.hdf5', 'w')
-        dset = f.create_dataset('dset', (len(dset_in), 16, 330, 256, 2))
+        f = open_hdf5('data.hdf5', 'w')
+        dset = create_dataset(f, 'dset', (len(dset_in), 16, 330, 256, 2), access='channel',
+                              compress=True, precision=PRECISION_POLICY['hourglass_predictions'])
 
         predict = train_augmented_hourglass_cnn('train-0', 8)
         for i, (pred, _) in enumerate(predict(dset_in)):
@@ -381,8 +371,8 @@ def get_augmented_hourglass_predictions(mode):
         f.close()
         open('done', 'w').close()
 
-    f = h5py.File('data.hdf5', 'r')
-    dset = f['dset']
+    f = open_hdf5('data.hdf5')
+    dset = open_dataset(f, 'dset')
     return dset
 
 
@@ -473,7 +463,7 @@ def train_resnet50_fcn(mode, epochs, learning_rate=1e-3, num_layers=3, data_idx=
     def predict(dset, n_sample=16):
         model = keras.models.load_model(model_path, custom_objects={'tf': tf})
         for data in tqdm.tqdm(dset):
-            ret = np.zeros((16, height, width))
+            ret = np.zeros((16, height, width), dtype='float32')
             for _ in range(n_sample):
                 images = data[:, ::downsize, ::downsize, 0]
                 images = np.stack([images] * 3, axis=-1)
@@ -558,7 +548,8 @@ def train_multitask_fcn(mode, cvid, lid, duration, learning_rate=1e-5, num_layer
 
     model_path = os.getcwd() + '/model.h5'
 
-    dset_all, _ = passenger_clustering.get_augmented_segmentation_data(mode, 10)
+    dset_all, _ = passenger_clustering.get_augmented_segmentation_data(
+        mode, 10, passenger_clustering.AUGMENTATION_QUEUE_DIR)
     labels_all, _ = dataio.get_augmented_threat_heatmaps(mode)
     train_idx, valid_idx = get_train_idx(mode, cvid), get_valid_idx(mode, cvid)
 
@@ -759,8 +750,8 @@ def get_hourglass_cnn_predictions(mode, *args, **kwargs):
         ranges, _, _, dset = passenger_clustering.get_clustered_data_and_threat_heatmaps(mode,
                                 kwargs.get('cluster_type', 'groundtruth'))
 
-        f = h5py.File('data.hdf5', 'w')
-        out = f.create_dataset('out', (len(dset), 16, 660, 512))
+        f = open_hdf5('data.hdf5', 'w')
+        out = create_dataset(f, 'out', (len(dset), 16, 660, 512))
         with model:
             for group in tqdm.tqdm(ranges):
                 for i in tqdm.trange(*group):
@@ -769,7 +760,7 @@ def get_hourglass_cnn_predictions(mode, *args, **kwargs):
                     out[i] /= group[1] - group[0]
         open('done', 'w').close()
     else:
-        f = h5py.File('data.hdf5', 'r')
+        f = open_hdf5('data.hdf5')
         out = f['out']
     return out
 
@@ -869,7 +860,7 @@ def train_unet_cnn(mode, batch_size, learning_rate, duration, rotate_images=Fals
         with tf.Session() as sess:
             saver.restore(sess, model_path)
             for data in batch_gen(dset):
-                pred = np.zeros((16, height, width))
+                pred = np.zeros((16, height, width), dtype='float32')
                 for _ in range(n_sample):
                     pred += sess.run(pred_hmap, feed_dict=feed(data, False))
                 yield pred / n_sample